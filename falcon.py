@@ -1,295 +1,2828 @@
 #!/usr/bin/env python3
-import unittest, json, gc
+import unittest, json, os, sys, heapq, itertools, mmap, random, resource, fcntl, zlib, lzma, bz2
+from math import log as logarithm
 from sqlite3 import connect
 from pickle import loads, dumps
-from bz2 import compress, decompress
+from array import array
+from operator import add
+from struct import Struct
+from bisect import bisect_left
+from codecs import getincrementaldecoder
 from re import compile, split
 from argparse import ArgumentParser
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time, perf_counter
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
+from multiprocessing import Pool
+from collections import deque, OrderedDict
+from threading import Thread, Lock, Event, get_ident
+from functools import wraps
+from queue import Queue, LifoQueue, Empty
+from contextlib import contextmanager, ExitStack
+from tempfile import TemporaryDirectory
 
 _DEFAULT_TOKENIZER = 'Bigram'
-_COMPRESS_LEVEL = 9
+_DEFAULT_COMPRESSION = 'Zlib'
+_DOCUMENT_MAGIC = b'FD'
+_DOCUMENT_VERSION = 1
+_DOCUMENT_BLOCK_SIZE = 16384
+_DOCUMENT_READ_SIZE = 4096
+_SNIPPET_SIZE = 100
 _DEFAULT_PORT = 8888
-_TOKEN_POSITION_LIMIT = 5000000
+_DEFAULT_MEMORY_BUDGET = 256
+_BUFFER_TOKEN_BYTES = 550
+_BUFFER_DOCUMENT_BYTES = 20
+_BUFFER_POSITION_BYTES = 10
+_RUN_RECORD = Struct('<II')
+_RUN_READ_SIZE = 1048576
+_SCHEMA_VERSION = 8
+_POSTING_LIST_MAGIC = b'FP'
+_POSTING_LIST_VERSION = 1
+_BITMAP_MAGIC = b'FB'
+_BITMAP_VERSION = 1
+_BITMAP_ARRAY_LIMIT = 4096
+_BITMAP_CONTAINER_BYTES = 8192
+_BITMAP_BYTE_BITS = [tuple(bit for bit in range(0, 8) if byte >> bit & 1) for byte in range(0, 256)]
+_SQL_CHUNK_SIZE = 1000
+_BULK_CHUNK_SIZE = 1000
+_BULK_QUEUE_DEPTH = 2
+_BUSY_TIMEOUT = 60
+_BACKUP_PAGES = 1024
+_MERGE_FACTOR = 10
+_SEGMENT_BASE_SIZE = 1048576
+_CONNECTION_POOL_SIZE = 8
+_POSTING_LIST_CACHE_SIZE = 67108864
+_CACHE_ENTRY_OVERHEAD = 256
+_QUERY_RESULT_CACHE_SIZE = 16777216
+_GROUP_COMMIT_INTERVAL = 0.05
+_GROUP_COMMIT_SIZE = 1000
+_PURGE_THRESHOLD = 1000
+_DEFAULT_LIMIT = 10
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_SHARD_MANIFEST_VERSION = 1
+_FROZEN_INDEX_MAGIC = b'FALCONFI'
+_FROZEN_INDEX_VERSION = 1
+_FROZEN_INDEX_BYTE_ORDER = 0x01020304
+_FROZEN_INDEX_HEADER = Struct('=8sIIqqqqqqqqqqq16s')
+_BENCHMARK_VERSION = 1
+_BENCHMARK_DOCUMENTS = 2000
+_BENCHMARK_QUERIES = 100
+_BENCHMARK_SEED = 1
+_BENCHMARK_VOCABULARY_SIZE = 20000
+_BENCHMARK_ZIPF_EXPONENT = 1.07
+_BENCHMARK_TOLERANCE = 0.1
+_METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_PROFILER_INTERVAL = 0.01
+_STOPWORD_CHARACTERS = r'\s,.!?"\'$%&\-+=/#:;{}\[\]()<>\^~_→｡@･ﾞ､｢｣…★☆♭\\–▼♪⇔♥°‐――≠※∞◇×、。（）：；「」『』【】［］｛｝〈〉《》〔〕〜～�｜｀＼＠？！”＃＄％＆’＝＋＊＜＞＿＾￥／，・´ ▽ ．－￤'
+
+_MISSING = object()
+_logged_methods = []
+_timed_methods = []
 
 def log(method):
-    def wrapper(self, *args):
-        if IndexManager.debug:
-            print('begin:', self.__class__.__name__, method.__name__)
-            print(args)
-        result = method(self, *args)
-        if IndexManager.debug:
-            print('end:', self.__class__.__name__, method.__name__)
+    _logged_methods.append((method, None))
+    return method
+
+def timed(stage):
+    def register(method):
+        _timed_methods.append((method, stage))
+        return method
+    return register
+
+def _instrument(methods, wrap):
+    module = sys.modules[__name__]
+    for method, argument in methods:
+        class_name, name = method.__qualname__.split('.')
+        clazz = getattr(module, class_name)
+        setattr(clazz, name, wrap(clazz.__dict__[name], argument))
+
+def _debug_wrapper(method, argument):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        print('begin:', self.__class__.__name__, method.__name__)
+        print(args)
+        if len(kwargs) > 0:
+            print(kwargs)
+        result = method(self, *args, **kwargs)
+        print('end:', self.__class__.__name__, method.__name__)
         return result
     return wrapper
 
-class Tokenizer(object):
+def _enable_debug():
+    if not IndexManager.debug:
+        _instrument(_logged_methods, _debug_wrapper)
+        IndexManager.debug = True
+
+class Metrics(object):
+    def __init__(self, buckets = _METRICS_BUCKETS):
+        self.enabled = False
+        self._buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    def enable(self):
+        if not self.enabled:
+            _instrument(_timed_methods, self._timer)
+            self.enabled = True
+
+    def _timer(self, method, stage):
+        labels = 'stage="{0}"'.format(stage)
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.observe('falcon_stage_seconds', labels, perf_counter() - start)
+        return wrapper
+
+    def observe(self, name, labels, seconds):
+        index = bisect_left(self._buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram == None:
+                histogram = self._histograms[(name, labels)] = [0] * (len(self._buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def increment(self, name, labels, amount = 1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    def histogram(self, name, labels):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            return None if histogram == None else {'count': sum(histogram[:-1]), 'sum': histogram[-1]}
+
+    def render(self, gauges = {}):
+        with self._lock:
+            histograms = sorted((key, list(histogram)) for key, histogram in self._histograms.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        previous_name = None
+        for (name, labels), histogram in histograms:
+            if name != previous_name:
+                lines.append('# TYPE {0} histogram'.format(name))
+                previous_name = name
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf',), histogram):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, 'le="{0}"'.format(bound)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), histogram[-1]))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels), cumulative))
+        for (name, labels), value in counters:
+            if name != previous_name:
+                lines.append('# TYPE {0} counter'.format(name))
+                previous_name = name
+            lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+def _labels(*labels):
+    labels = ','.join(label for label in labels if label != '')
+    return '{' + labels + '}' if labels != '' else ''
+
+_metrics = Metrics()
+
+class SamplingProfiler(object):
+    def __init__(self, interval = _PROFILER_INTERVAL):
+        self._interval = interval
+        self._samples = {}
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target = self._sample, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        own_thread = get_ident()
+        while not self._stopped.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name)))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                self._samples[stack] = self._samples.get(stack, 0) + 1
+
+    def samples(self):
+        return dict(self._samples)
+
+    def dump(self, f):
+        for stack, count in sorted(self.samples().items()):
+            f.write('{0} {1}\n'.format(stack, count))
+
+class Vocabulary(dict):
+    def __init__(self):
+        self.tokens = []
+
+    def __missing__(self, token):
+        token_id = len(self.tokens)
+        self[token] = token_id
+        self.tokens.append(token)
+        return token_id
+
+class StopwordTable(dict):
+    def __init__(self, stopwords):
+        self._stopwords = stopwords
+
+    def __missing__(self, character):
+        flag = 0 if self._stopwords.match(chr(character)) else 1
+        self[character] = flag
+        return flag
+
+class Tokenizer(object):
+    @log
+    def __init__(self):
+        self.stopwords = compile('[{0}]'.format(_STOPWORD_CHARACTERS))
+
+    @log
+    def tokenize(self, title, content):
+        raise NotImplementedError("tokenize method must be overridden and implemented by a descendant class.")
+
+class NgramTokenizer(Tokenizer):
+    size = None
+
+    @log
+    def __init__(self):
+        Tokenizer.__init__(self)
+        self._flags = StopwordTable(self.stopwords)
+
+    @log
+    @timed('tokenize')
+    def tokenize(self, title, content = ''):
+        document = ''.join([title, content])
+        valid = self._valid(document)
+        return list(zip(itertools.compress(range(len(document)), valid), itertools.compress(self._ngrams(document), valid)))
+
+    @log
+    @timed('tokenize')
+    def tokenize_ids(self, documents, vocabulary):
+        documents = [''.join(document) for document in documents]
+        text = '\n'.join(documents)
+        valid = self._valid(text)
+        ends = list(itertools.accumulate(len(document) + 1 for document in documents))
+        counts = array('l', (valid.count(1, end - len(document) - 1, end) for document, end in zip(documents, ends)))
+        positions = array('l', itertools.compress(itertools.chain.from_iterable(range(len(document) + 1) for document in documents), valid))
+        token_ids = array('l', map(vocabulary.__getitem__, itertools.compress(self._ngrams(text), valid)))
+        return counts, positions, token_ids
+
+    def _valid(self, document):
+        flags = int.from_bytes(document.translate(self._flags).encode('ascii'), 'big')
+        valid = flags
+        for i in range(1, self.size):
+            valid = valid & (flags << (8 * i))
+        return valid.to_bytes(len(document), 'big')
+
+    def _ngrams(self, document):
+        ngrams = document
+        for i in range(1, self.size):
+            ngrams = map(add, ngrams, document[i:])
+        return ngrams
+
+class BigramTokenizer(NgramTokenizer):
+    size = 2
+
+class TrigramTokenizer(NgramTokenizer):
+    size = 3
+
+class TokenizerFactory(object):
+    @log
+    def create_tokenizer(self, tokenizer):
+        module = sys.modules[__name__]
+        class_name = tokenizer + 'Tokenizer'
+        clazz = None
+        try:
+            clazz = getattr(module, class_name)
+        except AttributeError:
+            print(class_name + ' is not implemented.')
+            exit(1)
+        return clazz()
+
+class DocumentCodec(object):
+    codec_id = None
+    default_level = None
+
+    @log
+    def __init__(self, level = None):
+        self.level = self.default_level if level == None else level
+
+    @log
+    def encode(self, data):
+        return b''.join([_DOCUMENT_MAGIC, bytes([_DOCUMENT_VERSION, self.codec_id]), self._compress(data)])
+
+    def _compress(self, data):
+        raise NotImplementedError("_compress method must be overridden and implemented by a descendant class.")
+
+    def _decompressor(self):
+        raise NotImplementedError("_decompressor method must be overridden and implemented by a descendant class.")
+
+    def decompress_chunks(self, data, size):
+        decompressor = self._decompressor()
+        yield decompressor.decompress(data, size or -1)
+        while not decompressor.eof and not decompressor.needs_input:
+            yield decompressor.decompress(b'', size or -1)
+
+class ZlibDocumentCodec(DocumentCodec):
+    codec_id = 1
+    default_level = 6
+
+    def _compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress_chunks(self, data, size):
+        decompressor = zlib.decompressobj()
+        while len(data) > 0 and not decompressor.eof:
+            yield decompressor.decompress(data, size)
+            data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+class LzmaDocumentCodec(DocumentCodec):
+    codec_id = 2
+    default_level = 6
+
+    def _compress(self, data):
+        return lzma.compress(data, preset = self.level)
+
+    def _decompressor(self):
+        return lzma.LZMADecompressor()
+
+class Bz2DocumentCodec(DocumentCodec):
+    codec_id = 3
+    default_level = 9
+
+    def _compress(self, data):
+        return bz2.compress(data, self.level)
+
+    def _decompressor(self):
+        return bz2.BZ2Decompressor()
+
+class DocumentCodecFactory(object):
+    @log
+    def create_codec(self, compression):
+        name, _, level = compression.partition(':')
+        module = sys.modules[__name__]
+        class_name = name + 'DocumentCodec'
+        clazz = None
+        try:
+            clazz = getattr(module, class_name)
+        except AttributeError:
+            print(class_name + ' is not implemented.')
+            exit(1)
+        return clazz(int(level) if level != '' else None)
+
+    @log
+    def codec_of(self, blob):
+        if blob[0:len(_DOCUMENT_MAGIC)] != _DOCUMENT_MAGIC:
+            return Bz2DocumentCodec(), blob
+        if blob[len(_DOCUMENT_MAGIC)] != _DOCUMENT_VERSION:
+            raise ValueError('Unsupported document version: {0}'.format(blob[len(_DOCUMENT_MAGIC)]))
+        codec_id = blob[len(_DOCUMENT_MAGIC) + 1]
+        for clazz in DocumentCodec.__subclasses__():
+            if clazz.codec_id == codec_id:
+                return clazz(), blob[len(_DOCUMENT_MAGIC) + 2:]
+        raise ValueError('Unsupported document codec: {0}'.format(codec_id))
+
+class DocumentStore(object):
+    @log
+    def __init__(self, compression = _DEFAULT_COMPRESSION):
+        self._codec = DocumentCodecFactory().create_codec(compression)
+
+    @log
+    def encode(self, content):
+        return self._codec.encode(content.encode('utf-8'))
+
+    @log
+    def pack(self, contents):
+        rows = []
+        blocks = []
+        block = []
+        members = []
+        for content in contents:
+            data = content.encode('utf-8')
+            if len(data) >= _DOCUMENT_BLOCK_SIZE:
+                rows.append((self._codec.encode(data), None, None))
+                continue
+            members.append(len(rows))
+            rows.append((None, len(blocks), len(block)))
+            block.append(data)
+            if sum(map(len, block)) >= _DOCUMENT_BLOCK_SIZE:
+                blocks.append(self._pack_block(block))
+                block = []
+                members = []
+        if len(block) == 1:
+            rows[members[0]] = (self._codec.encode(block[0]), None, None)
+        elif len(block) > 1:
+            blocks.append(self._pack_block(block))
+        return rows, blocks
+
+    def _pack_block(self, block):
+        header = bytearray()
+        _encode_varint(len(block), header)
+        for data in block:
+            _encode_varint(len(data), header)
+        return bytes(header) + self._codec.encode(b''.join(block))
+
+    @log
+    def unpack_block(self, block):
+        data = memoryview(block)
+        (count,), offset = _decode_varints(data, 0, 1)
+        lengths, offset = _decode_varints(data, offset, count)
+        payload = _decompress(data[offset:])
+        contents = []
+        start = 0
+        for length in lengths:
+            contents.append(str(payload[start:start + length], encoding = 'utf-8'))
+            start = start + length
+        return contents
+
+    @log
+    def read(self, content, characters = None):
+        if characters == None:
+            return str(_decompress(content), encoding = 'utf-8')
+        texts = []
+        length = 0
+        decoder = getincrementaldecoder('utf-8')()
+        codec, data = DocumentCodecFactory().codec_of(content)
+        for chunk in codec.decompress_chunks(data, _DOCUMENT_READ_SIZE):
+            texts.append(decoder.decode(chunk))
+            length = length + len(texts[-1])
+            if length >= characters:
+                break
+        return ''.join(texts)
+
+def _decompress(blob):
+    codec, data = DocumentCodecFactory().codec_of(blob)
+    return b''.join(codec.decompress_chunks(data, 0))
+
+def _snippet(title, content, position, size):
+    start = max(0, position - len(title) - size // 2)
+    return content[start:start + size]
+
+class Indexer(object):
+    @log
+    def __init__(self, database_file, memory_mode, tokenizer_type, memory_budget = _DEFAULT_MEMORY_BUDGET, checkpoint_interval = None, compression = _DEFAULT_COMPRESSION):
+        self._database_file = database_file
+        self._memory_mode = memory_mode
+        self._tokenizer_type = tokenizer_type
+        self._tokenizer = TokenizerFactory().create_tokenizer(tokenizer_type)
+        self._compression = compression
+        self._documents = DocumentStore(compression)
+        self._vocabulary = Vocabulary()
+        self._inverted_index = {}
+        self._buffer_size = 0
+        self._memory_budget = memory_budget * 1048576
+        self._spill_directory = None
+        self._runs = []
+        self._document_count = 0
+        self._total_length = 0
+        self._codec = PostingListCodec()
+        self._bitmap_codec = DocumentBitmapCodec()
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpointed = time()
+        self._connection = connect(self._database_file if not self._memory_mode else ':memory:', isolation_level = 'DEFERRED', timeout = _BUSY_TIMEOUT)
+        if self._memory_mode and os.path.exists(self._database_file):
+            source = connect(self._database_file, timeout = _BUSY_TIMEOUT)
+            source.backup(self._connection, pages = _BACKUP_PAGES)
+            source.close()
+        self._connection.execute("PRAGMA journal_mode = MEMORY")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'indices'")
+        if cursor.fetchone()[0] == 0:
+            self._create_tables(cursor)
+            cursor.execute('PRAGMA user_version = {0}'.format(_SCHEMA_VERSION))
+        else:
+            self.migrate()
+        self._merger = SegmentMerger(self._database_file, self._connection if self._memory_mode or self._database_file == ':memory:' else None)
+
+    @log
+    def _create_tables(self, cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS indices (
+                  token TEXT
+                , segment INTEGER
+                , posting_list BLOB
+                , bitmap BLOB
+                , PRIMARY KEY (token, segment)
+            )
+        """)
+        cursor.execute('CREATE INDEX IF NOT EXISTS indices_segment ON indices (segment)')
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS segments (
+                  id INTEGER PRIMARY KEY
+                , level INTEGER
+                , size INTEGER
+                , merged_into INTEGER
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                  id INTEGER PRIMARY KEY
+                , title TEXT
+                , content BLOB
+                , length INTEGER
+                , block INTEGER
+                , block_index INTEGER
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS blocks (
+                  id INTEGER PRIMARY KEY
+                , data BLOB
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tombstones (
+                  document_id INTEGER PRIMARY KEY
+                , segment INTEGER
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS purge_tokens (
+                  token TEXT PRIMARY KEY
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                  key TEXT PRIMARY KEY
+                , value
+            )
+        """)
+        cursor.executemany('INSERT OR IGNORE INTO metadata (key, value) VALUES (?, 0)', [('generation',), ('document_count',), ('total_length',), ('last_document_id',)])
+
+    @log
+    def add_index(self, title, content, document_id = 0):
+        counts, positions, token_ids = self._tokenizer.tokenize_ids([(title, content)], self._vocabulary)
+        if(document_id == 0):
+            document_id = self._store_document(title, content, counts[0])
+        self._create_posting_list(document_id, zip(positions, token_ids))
+        self._flush_buffer()
+        self._checkpoint_if_due()
+        return document_id
+
+    @log
+    def _store_document(self, title, content, length):
+        cursor = self._connection.cursor()
+        compressed = self._documents.encode(content)
+        document_id = self._allocate_document_ids(1)[0]
+        cursor.execute('INSERT INTO documents (id, title, content, length) VALUES(?, ?, ?, ?)', (document_id, title, compressed, length))
+        self._document_count = self._document_count + 1
+        self._total_length = self._total_length + length
+        return document_id
+
+    @log
+    def _allocate_document_ids(self, count, document_ids = None):
+        cursor = self._connection.cursor()
+        if document_ids == None:
+            cursor.execute("UPDATE metadata SET value = value + ? WHERE key = 'last_document_id'", (count,))
+            cursor.execute("SELECT value FROM metadata WHERE key = 'last_document_id'")
+            last_document_id = cursor.fetchone()[0]
+            return range(last_document_id - count + 1, last_document_id + 1)
+        if len(document_ids) > 0:
+            cursor.execute("UPDATE metadata SET value = max(value, ?) WHERE key = 'last_document_id'", (max(document_ids),))
+        return document_ids
+
+    @log
+    def add_documents(self, documents, document_ids = None):
+        return self._add_batch(*_tokenize_documents(self._tokenizer_type, documents, self._compression), document_ids)
+
+    @log
+    def add_files(self, file_names, processes = None):
+        processes = processes or os.cpu_count()
+        pending = deque()
+        with Pool(processes) as pool:
+            for documents in _read_documents(file_names, _BULK_CHUNK_SIZE):
+                pending.append(pool.apply_async(_tokenize_documents, (self._tokenizer_type, documents, self._compression)))
+                if len(pending) > processes * _BULK_QUEUE_DEPTH:
+                    self._add_batch(*pending.popleft().get())
+                    self.commit()
+            while len(pending) > 0:
+                self._add_batch(*pending.popleft().get())
+                self.commit()
+
+    @log
+    def _add_batch(self, documents, blocks, partial_index, document_ids = None):
+        cursor = self._connection.cursor()
+        document_ids = self._allocate_document_ids(len(documents), document_ids)
+        block_ids = []
+        for block in blocks:
+            cursor.execute('INSERT INTO blocks (data) VALUES (?)', (block,))
+            block_ids.append(cursor.lastrowid)
+        cursor.executemany('INSERT INTO documents (id, title, content, length, block, block_index) VALUES(?, ?, ?, ?, ?, ?)', [(document_id, title, content, length, block_ids[block] if block != None else None, block_index) for document_id, (title, content, length, block, block_index) in zip(document_ids, documents)])
+        self._document_count = self._document_count + len(documents)
+        self._total_length = self._total_length + sum(length for title, content, length, block, block_index in documents)
+        self._merge_partial_index({self._vocabulary[token]: posting_list for token, posting_list in partial_index.items()}, document_ids)
+        self._flush_buffer()
+        self._checkpoint_if_due()
+        return list(document_ids)
+
+    @log
+    def update_documents(self, documents):
+        tombstoned = self._tombstone([document_id for document_id, title, content in documents])
+        documents = [(document_id, title, content) for document_id, title, content in documents if document_id in tombstoned]
+        if len(documents) == 0:
+            return []
+        return self._add_batch(*_tokenize_documents(self._tokenizer_type, [(title, content) for document_id, title, content in documents], self._compression), [document_id for document_id, title, content in documents])
+
+    @log
+    def delete_documents(self, document_ids):
+        return list(self._tombstone(document_ids))
+
+    @log
+    def _tombstone(self, document_ids):
+        self._flush_buffer(True)
+        cursor = self._connection.cursor()
+        if not self._connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT coalesce(max(id), 0) FROM segments')
+        segment = cursor.fetchone()[0]
+        tombstoned = OrderedDict()
+        for i in range(0, len(document_ids), _SQL_CHUNK_SIZE):
+            chunk = document_ids[i:i+_SQL_CHUNK_SIZE]
+            cursor.execute('SELECT d.id, d.title, d.content, d.length, d.block_index, b.data FROM documents d LEFT JOIN blocks b ON b.id = d.block WHERE d.id IN({0})'.format(', '.join('?' for document_id in chunk)), chunk)
+            tokens = set()
+            for document_id, title, content, length, block_index, block in cursor.fetchall():
+                content = self._documents.unpack_block(block)[block_index] if block != None else self._documents.read(content)
+                tokens.update(token for i, token in self._tokenizer.tokenize(title, content))
+                tombstoned[document_id] = length or 0
+            cursor.executemany('INSERT OR IGNORE INTO purge_tokens (token) VALUES (?)', [(token,) for token in tokens])
+        if len(tombstoned) > 0:
+            cursor.executemany('INSERT OR REPLACE INTO tombstones (document_id, segment) VALUES (?, ?)', [(document_id, segment) for document_id in tombstoned])
+            cursor.executemany('DELETE FROM documents WHERE id = ?', [(document_id,) for document_id in tombstoned])
+            cursor.execute("UPDATE metadata SET value = value + 1 WHERE key = 'generation'")
+            self._document_count = self._document_count - len(tombstoned)
+            self._total_length = self._total_length - sum(tombstoned.values())
+        return tombstoned
+
+    @log
+    def purge(self):
+        self.commit()
+        self._merger.join()
+        return self._merger.purge(self._connection)
+
+    @log
+    def _create_posting_list(self, document_id, tokens):
+        partial_index = {}
+        for i, token_id in tokens:
+            if token_id in partial_index:
+                partial_index[token_id][0].append(i)
+            else:
+                partial_index[token_id] = {0: [i]}
+        self._merge_partial_index(partial_index, [document_id])
+
+    @log
+    def _merge_partial_index(self, partial_index, document_ids):
+        for token_id, posting_list in partial_index.items():
+            posting_list_buffer = self._inverted_index.get(token_id)
+            if posting_list_buffer == None:
+                posting_list_buffer = PostingListBuffer()
+                self._inverted_index[token_id] = posting_list_buffer
+                self._buffer_size += sys.getsizeof(self._vocabulary.tokens[token_id]) + _BUFFER_TOKEN_BYTES
+            for offset, positions in posting_list.items():
+                posting_list_buffer.extend(document_ids[offset], positions)
+                self._buffer_size += _BUFFER_DOCUMENT_BYTES + _BUFFER_POSITION_BYTES * len(positions)
+
+    @log
+    @timed('flush')
+    def _flush_buffer(self, final = False):
+        if len(self._inverted_index) > 0 and not final and self._buffer_size > self._memory_budget:
+            self._spill()
+        elif final and len(self._runs) > 0:
+            self._merge_runs()
+        elif final and len(self._inverted_index) > 0:
+            self._write_segment((self._vocabulary.tokens[token_id], self._codec.encode(posting_list_buffer.to_dict()), DocumentBitmap(sorted(posting_list_buffer.document_ids))) for token_id, posting_list_buffer in self._inverted_index.items())
+            self._clear_buffer()
+
+    @log
+    def _clear_buffer(self):
+        self._vocabulary = Vocabulary()
+        self._inverted_index = {}
+        self._buffer_size = 0
+
+    @log
+    def _discard_buffer(self):
+        for file_name in self._runs:
+            os.remove(file_name)
+        self._runs = []
+        self._clear_buffer()
+
+    @log
+    def _spill(self):
+        if self._spill_directory == None:
+            self._spill_directory = TemporaryDirectory(prefix = 'falcon-')
+        file_name = os.path.join(self._spill_directory.name, '{0}.run'.format(len(self._runs)))
+        with open(file_name, 'wb') as f:
+            for token_id in sorted(self._inverted_index, key = self._vocabulary.tokens.__getitem__):
+                token_bytes = self._vocabulary.tokens[token_id].encode('utf-8')
+                blob = self._codec.encode(self._inverted_index[token_id].to_dict())
+                f.write(_RUN_RECORD.pack(len(token_bytes), len(blob)))
+                f.write(token_bytes)
+                f.write(blob)
+        self._runs.append(file_name)
+        self._clear_buffer()
+        if _metrics.enabled:
+            _metrics.increment('falcon_index_spills_total', '', 1)
+
+    @log
+    def _merge_runs(self):
+        if len(self._inverted_index) > 0:
+            self._spill()
+        self._write_segment(self._merged_rows([_read_run(file_name) for file_name in self._runs]))
+        for file_name in self._runs:
+            os.remove(file_name)
+        self._runs = []
+
+    @log
+    def _merged_rows(self, runs):
+        for token, records in itertools.groupby(heapq.merge(*runs, key = lambda record: record[0]), key = lambda record: record[0]):
+            blobs = [blob for token, blob in records]
+            posting_list = self._codec.union([self._codec.decode(blob) for blob in blobs])
+            yield token, blobs[0] if len(blobs) == 1 else self._codec.encode(posting_list.to_dict()), DocumentBitmap(posting_list.document_ids)
+
+    @log
+    def _write_segment(self, rows):
+        cursor = self._connection.cursor()
+        cursor.execute('INSERT INTO segments (level, size) VALUES (0, 0)')
+        segment = cursor.lastrowid
+        size = 0
+        rows = iter(rows)
+        chunk = list(itertools.islice(rows, _SQL_CHUNK_SIZE))
+        while len(chunk) > 0:
+            cursor.executemany('INSERT INTO indices (token, segment, posting_list, bitmap) VALUES (?, {0}, ?, ?)'.format(segment), [(token, blob, self._bitmap_codec.encode(bitmap)) for token, blob, bitmap in chunk])
+            size = size + sum(len(blob) for token, blob, bitmap in chunk)
+            chunk = list(itertools.islice(rows, _SQL_CHUNK_SIZE))
+        cursor.execute('UPDATE segments SET level = ?, size = ? WHERE id = ?', (_segment_level(size), size, segment))
+        cursor.execute("UPDATE metadata SET value = value + 1 WHERE key = 'generation'")
+
+    @contextmanager
+    def savepoint(self):
+        self._flush_buffer(True)
+        document_count = self._document_count
+        total_length = self._total_length
+        cursor = self._connection.cursor()
+        if not self._connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SAVEPOINT item')
+        try:
+            yield
+        except:
+            cursor.execute('ROLLBACK TO item')
+            cursor.execute('RELEASE item')
+            self._discard_buffer()
+            self._document_count = document_count
+            self._total_length = total_length
+            raise
+        cursor.execute('RELEASE item')
+
+    @log
+    def flush(self):
+        self._flush_buffer(True)
+        self.commit()
+
+    @log
+    @timed('commit')
+    def commit(self):
+        if self._document_count != 0 or self._total_length != 0:
+            cursor = self._connection.cursor()
+            cursor.executemany('UPDATE metadata SET value = value + ? WHERE key = ?', [(self._document_count, 'document_count'), (self._total_length, 'total_length')])
+            if _metrics.enabled and self._document_count > 0:
+                _metrics.increment('falcon_documents_indexed_total', '', self._document_count)
+            self._document_count = 0
+            self._total_length = 0
+        self._connection.commit()
+        self._merger.request()
+
+    @log
+    def _checkpoint_if_due(self):
+        if self._memory_mode and self._checkpoint_interval != None and time() - self._checkpointed >= self._checkpoint_interval:
+            self.flush_memory_to_file()
+
+    @log
+    @timed('checkpoint')
+    def flush_memory_to_file(self):
+        self._checkpointed = time()
+        self.flush()
+        temporary_file = '{0}.{1}.tmp'.format(self._database_file, os.getpid())
+        target = connect(temporary_file)
+        try:
+            try:
+                self._connection.backup(target, pages = _BACKUP_PAGES)
+            finally:
+                target.close()
+            os.replace(temporary_file, self._database_file)
+        finally:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+    @log
+    def migrate(self):
+        cursor = self._connection.cursor()
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return 0
+        migrated = 0
+        if version < 2:
+            cursor.execute('ALTER TABLE indices RENAME TO legacy_indices')
+            self._create_tables(cursor)
+            cursor.execute('INSERT INTO segments (size) VALUES (0)')
+            segment = cursor.lastrowid
+            cursor.execute('SELECT token FROM legacy_indices')
+            tokens = [token for token, in cursor.fetchall()]
+            size = 0
+            for i in range(0, len(tokens), _SQL_CHUNK_SIZE):
+                chunk = tokens[i:i+_SQL_CHUNK_SIZE]
+                cursor.execute('SELECT token, posting_list FROM legacy_indices WHERE token IN({0})'.format(', '.join('?' for token in chunk)), chunk)
+                rows = []
+                for token, blob in cursor.fetchall():
+                    if not self._codec.is_encoded(blob):
+                        blob = self._codec.encode(loads(blob).posting_list)
+                        migrated = migrated + 1
+                    rows.append((token, blob))
+                    size = size + len(blob)
+                cursor.executemany('INSERT INTO indices (token, segment, posting_list) VALUES (?, {0}, ?)'.format(segment), rows)
+            cursor.execute('UPDATE segments SET level = ?, size = ? WHERE id = ?', (_segment_level(size), size, segment))
+            cursor.execute('DROP TABLE legacy_indices')
+        if version < 3:
+            self._create_tables(cursor)
+        if version < 4:
+            cursor.execute('PRAGMA table_info(documents)')
+            if 'length' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE documents ADD COLUMN length INTEGER')
+            cursor.execute('SELECT id FROM documents')
+            document_ids = [document_id for document_id, in cursor.fetchall()]
+            total_length = 0
+            for i in range(0, len(document_ids), _SQL_CHUNK_SIZE):
+                chunk = document_ids[i:i+_SQL_CHUNK_SIZE]
+                cursor.execute('SELECT id, title, content FROM documents WHERE id IN({0})'.format(', '.join('?' for document_id in chunk)), chunk)
+                rows = [(len(self._tokenizer.tokenize(title, self._documents.read(content))), document_id) for document_id, title, content in cursor.fetchall()]
+                cursor.executemany('UPDATE documents SET length = ? WHERE id = ?', rows)
+                total_length = total_length + sum(length for length, document_id in rows)
+            cursor.executemany('UPDATE metadata SET value = ? WHERE key = ?', [(len(document_ids), 'document_count'), (total_length, 'total_length')])
+        if version < 5:
+            cursor.execute('PRAGMA table_info(indices)')
+            if 'bitmap' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE indices ADD COLUMN bitmap BLOB')
+            cursor.execute('SELECT rowid FROM indices WHERE bitmap IS NULL')
+            row_ids = [row_id for row_id, in cursor.fetchall()]
+            for i in range(0, len(row_ids), _SQL_CHUNK_SIZE):
+                chunk = row_ids[i:i+_SQL_CHUNK_SIZE]
+                cursor.execute('SELECT rowid, posting_list FROM indices WHERE rowid IN({0})'.format(', '.join('?' for row_id in chunk)), chunk)
+                cursor.executemany('UPDATE indices SET bitmap = ? WHERE rowid = ?', [(self._bitmap_codec.encode(self._bitmap_codec.decode(blob)), row_id) for row_id, blob in cursor.fetchall()])
+        if version < 6:
+            cursor.execute('PRAGMA table_info(documents)')
+            columns = [column[1] for column in cursor.fetchall()]
+            for column in ('block', 'block_index'):
+                if column not in columns:
+                    cursor.execute('ALTER TABLE documents ADD COLUMN {0} INTEGER'.format(column))
+            self._create_tables(cursor)
+        if version < 7:
+            self._create_tables(cursor)
+        if version < 8:
+            self._create_tables(cursor)
+            cursor.execute("UPDATE metadata SET value = max(value, (SELECT coalesce(max(id), 0) FROM documents), (SELECT coalesce(max(document_id), 0) FROM tombstones)) WHERE key = 'last_document_id'")
+        cursor.execute('PRAGMA user_version = {0}'.format(_SCHEMA_VERSION))
+        self._connection.commit()
+        return migrated
+
+    @log
+    def close_database_connection(self):
+        if self._memory_mode and self._database_file != ':memory:':
+            self.flush_memory_to_file()
+        else:
+            self._flush_buffer(True)
+            self.commit()
+        self._merger.join()
+        self._connection.close()
+        if self._spill_directory != None:
+            self._spill_directory.cleanup()
+
+def _segment_level(size):
+    level = 0
+    while size >= _SEGMENT_BASE_SIZE:
+        size = size // _MERGE_FACTOR
+        level = level + 1
+    return level
+
+class SegmentMerger(object):
+    @log
+    def __init__(self, database_file, connection = None):
+        self._database_file = database_file
+        self._connection = connection
+        self._codec = PostingListCodec()
+        self._bitmap_codec = DocumentBitmapCodec()
+        self._lock = Lock()
+        self._merge_lock = Lock()
+        self._thread = None
+        self._requested = False
+
+    @log
+    def request(self):
+        if self._connection != None:
+            self.merge()
+            self._purge_if_due(self._connection)
+            return
+        with self._lock:
+            self._requested = True
+            if self._thread == None:
+                self._thread = Thread(target = self._run, daemon = True)
+                self._thread.start()
+
+    @log
+    def join(self):
+        thread = self._thread
+        if thread != None:
+            thread.join()
+
+    def _run(self):
+        connection = connect(self._database_file, isolation_level = 'DEFERRED', timeout = _BUSY_TIMEOUT)
+        try:
+            while True:
+                with self._lock:
+                    if not self._requested:
+                        self._thread = None
+                        return
+                    self._requested = False
+                self.merge(connection)
+                self._purge_if_due(connection)
+        finally:
+            connection.close()
+
+    def _purge_if_due(self, connection):
+        if connection.execute('SELECT count(*) FROM tombstones').fetchone()[0] >= _PURGE_THRESHOLD:
+            self.purge(connection)
+
+    @log
+    @timed('merge')
+    def merge(self, connection = None):
+        connection = connection or self._connection
+        with self._merge_lock:
+            cursor = connection.cursor()
+            cursor.execute('SELECT merged_into, group_concat(id) FROM segments WHERE merged_into IS NOT NULL GROUP BY merged_into')
+            for target, sources in cursor.fetchall():
+                self._move(connection, target, [int(source) for source in sources.split(',')])
+            merged = 0
+            while True:
+                claimed = self._claim(connection)
+                if claimed == None:
+                    return merged
+                self._move(connection, *claimed)
+                merged = merged + 1
+
+    @log
+    @timed('purge')
+    def purge(self, connection = None):
+        connection = connection or self._connection
+        with self._merge_lock:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute('SELECT document_id, segment FROM tombstones')
+                tombstones = _Tombstones(cursor.fetchall())
+                if len(tombstones) == 0:
+                    return 0
+                cursor.execute('SELECT token FROM purge_tokens')
+                tokens = [token for token, in cursor.fetchall()]
+                purged = 0
+                for i in range(0, len(tokens), _SQL_CHUNK_SIZE):
+                    chunk = tokens[i:i+_SQL_CHUNK_SIZE]
+                    cursor.execute('SELECT token, segment, posting_list, bitmap FROM indices WHERE token IN({0})'.format(', '.join('?' for token in chunk)), chunk)
+                    for token, segment, blob, bitmap in cursor.fetchall():
+                        posting_list = self._codec.decode(blob)
+                        filtered = self._codec.exclude(posting_list, tombstones.excluded(segment, self._bitmap_codec.decode(bitmap)))
+                        if filtered is posting_list:
+                            continue
+                        if len(filtered) == 0:
+                            cursor.execute('DELETE FROM indices WHERE token = ? AND segment = ?', (token, segment))
+                        else:
+                            cursor.execute('UPDATE indices SET posting_list = ?, bitmap = ? WHERE token = ? AND segment = ?', (self._codec.encode(filtered.to_dict()), self._bitmap_codec.encode(DocumentBitmap(filtered.document_ids)), token, segment))
+                        purged = purged + 1
+                cursor.execute('DELETE FROM tombstones')
+                cursor.execute('DELETE FROM purge_tokens')
+                cursor.execute('DELETE FROM blocks WHERE id NOT IN (SELECT block FROM documents WHERE block IS NOT NULL)')
+                cursor.execute("UPDATE metadata SET value = value + 1 WHERE key = 'generation'")
+            finally:
+                connection.commit()
+        return purged
+
+    @log
+    def _claim(self, connection):
+        cursor = connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('SELECT id, level, size FROM segments WHERE merged_into IS NULL AND level IS NOT NULL ORDER BY id')
+            levels = {}
+            for segment, level, size in cursor.fetchall():
+                levels.setdefault(level, []).append((segment, size))
+            for level, segments in sorted(levels.items()):
+                if len(segments) >= _MERGE_FACTOR:
+                    sources = [segment for segment, size in segments[0:_MERGE_FACTOR]]
+                    cursor.execute('INSERT INTO segments (size) VALUES (?)', (sum(size for segment, size in segments[0:_MERGE_FACTOR]),))
+                    target = cursor.lastrowid
+                    cursor.execute('UPDATE segments SET merged_into = ? WHERE id IN({0})'.format(', '.join('?' for source in sources)), [target] + sources)
+                    return target, sources
+            return None
+        finally:
+            connection.commit()
+
+    @log
+    def _move(self, connection, target, sources):
+        cursor = connection.cursor()
+        placeholders = ', '.join('?' for source in sources)
+        cursor.execute('SELECT DISTINCT token FROM indices WHERE segment IN({0})'.format(placeholders), sources)
+        tokens = [token for token, in cursor.fetchall()]
+        cursor.execute('SELECT document_id, segment FROM tombstones')
+        tombstones = _Tombstones(cursor.fetchall())
+        for i in range(0, len(tokens), _SQL_CHUNK_SIZE):
+            chunk = tokens[i:i+_SQL_CHUNK_SIZE]
+            cursor.execute('SELECT token, segment, posting_list, bitmap FROM indices WHERE token IN({0}) AND segment IN({1}) ORDER BY token, segment'.format(', '.join('?' for token in chunk), placeholders + ', ?'), chunk + sources + [target])
+            posting_lists = {}
+            for token, segment, blob, bitmap in cursor.fetchall():
+                posting_lists.setdefault(token, []).append(self._codec.exclude(self._codec.decode(blob), tombstones.excluded(segment, self._bitmap_codec.decode(bitmap))))
+            posting_lists = {token: self._codec.union(posting_list) for token, posting_list in posting_lists.items()}
+            cursor.execute('DELETE FROM indices WHERE token IN({0}) AND segment = ?'.format(', '.join('?' for token in chunk)), chunk + [target])
+            posting_lists = {token: posting_list for token, posting_list in posting_lists.items() if len(posting_list) > 0}
+            cursor.executemany('INSERT OR REPLACE INTO indices (token, segment, posting_list, bitmap) VALUES (?, ?, ?, ?)', [(token, target, self._codec.encode(posting_list.to_dict()), self._bitmap_codec.encode(DocumentBitmap(posting_list.document_ids))) for token, posting_list in posting_lists.items()])
+            cursor.execute('DELETE FROM indices WHERE token IN({0}) AND segment IN({1})'.format(', '.join('?' for token in chunk), placeholders), chunk + sources)
+            connection.commit()
+        cursor.execute('SELECT size FROM segments WHERE id = ?', (target,))
+        size = cursor.fetchone()[0]
+        cursor.execute('UPDATE segments SET level = ? WHERE id = ?', (_segment_level(size), target))
+        cursor.execute('DELETE FROM segments WHERE id IN({0})'.format(placeholders), sources)
+        connection.commit()
+
+class _Tombstones(object):
+    def __init__(self, rows):
+        rows = sorted(rows, key = lambda row: row[1])
+        self._document_ids = [document_id for document_id, segment in rows]
+        self._segments = [segment for document_id, segment in rows]
+        self._excluded = {}
+
+    def __len__(self):
+        return len(self._document_ids)
+
+    def excluded(self, segment, bitmap):
+        if segment not in self._excluded:
+            self._excluded[segment] = DocumentBitmap(sorted(self._document_ids[bisect_left(self._segments, segment):]))
+        return self._excluded[segment] & bitmap
+
+class InvertedIndexHash(object):
+    """Kept only so that pickled posting lists in databases older than schema version 2 can still be decoded."""
+
+    @log
+    def __init__(self, token, document_id, position):
+        self.token = token
+        self.posting_list = {}
+        self.posting_list[document_id] = [position]
+        self.positions_count = 1
+
+    @log
+    def add(self, document_id, position):
+        if document_id in self.posting_list:
+            self.posting_list[document_id].append(position)
+            self.positions_count = self.positions_count + 1
+        else:
+            self.posting_list[document_id] = [position]
+            self.positions_count = self.positions_count + 1
+
+class PostingListBuffer(object):
+    def __init__(self):
+        self.document_ids = array('l')
+        self.counts = array('l')
+        self.positions = array('l')
+
+    def extend(self, document_id, positions):
+        self.document_ids.append(document_id)
+        self.counts.append(len(positions))
+        self.positions.extend(positions)
+
+    def to_dict(self):
+        posting_list = {}
+        offset = 0
+        for document_id, count in zip(self.document_ids, self.counts):
+            posting_list[document_id] = self.positions[offset:offset + count]
+            offset = offset + count
+        return posting_list
+
+def _read_documents(file_names, chunk_size):
+    documents = []
+    for file_name in file_names:
+        with open(file_name) as f:
+            for line in f:
+                l = split(',', line, 1)
+                documents.append((l[0], l[1]))
+                if len(documents) == chunk_size:
+                    yield documents
+                    documents = []
+    if len(documents) > 0:
+        yield documents
+
+def _read_run(file_name):
+    with open(file_name, 'rb', buffering = _RUN_READ_SIZE) as f:
+        header = f.read(_RUN_RECORD.size)
+        while len(header) == _RUN_RECORD.size:
+            token_length, blob_length = _RUN_RECORD.unpack(header)
+            yield f.read(token_length).decode('utf-8'), f.read(blob_length)
+            header = f.read(_RUN_RECORD.size)
+
+def _index_shard(database_file, tokenizer_type, documents, document_ids, memory_budget = _DEFAULT_MEMORY_BUDGET, compression = _DEFAULT_COMPRESSION):
+    indexer = Indexer(database_file, False, tokenizer_type, memory_budget, compression = compression)
+    indexer.add_documents(documents, document_ids)
+    indexer.close_database_connection()
+
+def _tokenize_documents(tokenizer_type, documents, compression = _DEFAULT_COMPRESSION):
+    tokenizer = TokenizerFactory().create_tokenizer(tokenizer_type)
+    vocabulary = Vocabulary()
+    counts, positions, token_ids = tokenizer.tokenize_ids(documents, vocabulary)
+    tokens = zip(positions, token_ids)
+    compressed_documents = []
+    partial_index = {}
+    rows, blocks = DocumentStore(compression).pack([content for title, content in documents])
+    for offset, ((title, content), count, (compressed, block, block_index)) in enumerate(zip(documents, counts, rows)):
+        compressed_documents.append((title, compressed, count, block, block_index))
+        document_index = {}
+        for i, token_id in itertools.islice(tokens, count):
+            if token_id in document_index:
+                document_index[token_id].append(i)
+            else:
+                document_index[token_id] = [i]
+        for token_id, token_positions in document_index.items():
+            if token_id in partial_index:
+                partial_index[token_id][offset] = token_positions
+            else:
+                partial_index[token_id] = {offset: token_positions}
+    return compressed_documents, blocks, {vocabulary.tokens[token_id]: posting_list for token_id, posting_list in partial_index.items()}
+
+def _encode_varint(value, buffer):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def _decode_varints(data, offset, count):
+    values = array('q')
+    append = values.append
+    value = 0
+    shift = 0
+    while count > 0:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            append(value)
+            value = 0
+            shift = 0
+            count -= 1
+    return values, offset
+
+class PostingList(object):
+    def __init__(self, document_ids, positions_counts, offsets, data):
+        self.document_ids = document_ids
+        self._positions_counts = positions_counts
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self.document_ids)
+
+    @property
+    def positions_count(self):
+        return sum(self._positions_counts)
+
+    @property
+    def size(self):
+        return len(self._data) + self.document_ids.itemsize * len(self.document_ids) * 3
+
+    def find(self, document_id):
+        index = bisect_left(self.document_ids, document_id)
+        if index < len(self.document_ids) and self.document_ids[index] == document_id:
+            return index
+        return -1
+
+    def count(self, index):
+        return self._positions_counts[index]
+
+    def positions(self, index):
+        deltas, _ = _decode_varints(self._data, self._offsets[index], self._positions_counts[index])
+        position = 0
+        for i, delta in enumerate(deltas):
+            position += delta
+            deltas[i] = position
+        return deltas
+
+    def items(self):
+        for index, document_id in enumerate(self.document_ids):
+            yield document_id, self.positions(index)
+
+    def to_dict(self):
+        return {document_id: list(positions) for document_id, positions in self.items()}
+
+class MergedPostingList(PostingList):
+    def __init__(self, posting_lists, excluded = None):
+        entries = {}
+        for posting_list in posting_lists:
+            for index, document_id in enumerate(posting_list.document_ids):
+                if excluded == None or document_id not in excluded:
+                    entries[document_id] = (posting_list, index)
+        self.document_ids = array('q', sorted(entries))
+        self._entries = [entries[document_id] for document_id in self.document_ids]
+        self._posting_lists = posting_lists
+
+    @property
+    def positions_count(self):
+        return sum(posting_list._positions_counts[index] for posting_list, index in self._entries)
+
+    @property
+    def size(self):
+        return sum(posting_list.size for posting_list in self._posting_lists) + 72 * len(self.document_ids)
+
+    def count(self, index):
+        posting_list, index = self._entries[index]
+        return posting_list.count(index)
+
+    def positions(self, index):
+        posting_list, index = self._entries[index]
+        return posting_list.positions(index)
+
+def _to_bitset(values):
+    bits = bytearray(_BITMAP_CONTAINER_BYTES)
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bits, 'little')
+
+def _from_bitset(bits):
+    values = array('H')
+    for offset, byte in enumerate(bits.to_bytes(_BITMAP_CONTAINER_BYTES, 'little')):
+        if byte:
+            values.extend(map((offset << 3).__add__, _BITMAP_BYTE_BITS[byte]))
+    return values
+
+def _cardinality(container):
+    return bin(container).count('1') if isinstance(container, int) else len(container)
+
+def _normalize_container(container):
+    if isinstance(container, int):
+        return container if _cardinality(container) > _BITMAP_ARRAY_LIMIT else _from_bitset(container)
+    return container if len(container) <= _BITMAP_ARRAY_LIMIT else _to_bitset(container)
+
+def _and_containers(container, other_container):
+    if isinstance(container, int) and isinstance(other_container, int):
+        return _normalize_container(container & other_container)
+    if isinstance(container, int):
+        container, other_container = other_container, container
+    if isinstance(other_container, int):
+        bits = other_container.to_bytes(_BITMAP_CONTAINER_BYTES, 'little')
+        return array('H', [value for value in container if bits[value >> 3] >> (value & 7) & 1])
+    return array('H', sorted(set(container).intersection(other_container)))
+
+def _or_containers(container, other_container):
+    if isinstance(container, int) or isinstance(other_container, int):
+        return (container if isinstance(container, int) else _to_bitset(container)) | (other_container if isinstance(other_container, int) else _to_bitset(other_container))
+    return _normalize_container(array('H', sorted(set(container).union(other_container))))
+
+def _andnot_containers(container, other_container):
+    if isinstance(container, int):
+        return _normalize_container(container & ~(other_container if isinstance(other_container, int) else _to_bitset(other_container)))
+    if isinstance(other_container, int):
+        bits = other_container.to_bytes(_BITMAP_CONTAINER_BYTES, 'little')
+        return array('H', [value for value in container if not bits[value >> 3] >> (value & 7) & 1])
+    return array('H', sorted(set(container).difference(other_container)))
+
+class DocumentBitmap(object):
+    def __init__(self, document_ids = (), containers = None):
+        if containers == None:
+            containers = {}
+            document_ids = document_ids if isinstance(document_ids, array) else array('q', document_ids)
+            start = 0
+            while start < len(document_ids):
+                key = document_ids[start] >> 16
+                end = bisect_left(document_ids, (key + 1) << 16, start)
+                containers[key] = _normalize_container(array('H', map((0xffff).__and__, document_ids[start:end])))
+                start = end
+        self.containers = containers
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __and__(self, other):
+        containers = {}
+        for key in self.containers.keys() & other.containers.keys():
+            container = _and_containers(self.containers[key], other.containers[key])
+            if _cardinality(container) > 0:
+                containers[key] = container
+        return DocumentBitmap(containers = containers)
+
+    def __or__(self, other):
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            containers[key] = _or_containers(containers[key], container) if key in containers else container
+        return DocumentBitmap(containers = containers)
+
+    def __sub__(self, other):
+        containers = {}
+        for key, container in self.containers.items():
+            if key in other.containers:
+                container = _andnot_containers(container, other.containers[key])
+            if _cardinality(container) > 0:
+                containers[key] = container
+        return DocumentBitmap(containers = containers)
+
+    def __contains__(self, document_id):
+        container = self.containers.get(document_id >> 16)
+        if container == None:
+            return False
+        value = document_id & 0xffff
+        if isinstance(container, int):
+            return container >> value & 1 == 1
+        index = bisect_left(container, value)
+        return index < len(container) and container[index] == value
+
+    @property
+    def size(self):
+        return sum(_BITMAP_CONTAINER_BYTES if isinstance(container, int) else container.itemsize * len(container) for container in self.containers.values()) + 64 * len(self.containers)
+
+    def to_array(self):
+        document_ids = array('q')
+        for key, container in sorted(self.containers.items()):
+            document_ids.extend(map((key << 16).__add__, _from_bitset(container) if isinstance(container, int) else container))
+        return document_ids
+
+class DocumentBitmapCodec(object):
+    @log
+    def __init__(self):
+        self._posting_list_codec = PostingListCodec()
+
+    @log
+    def encode(self, bitmap):
+        header = bytearray(_BITMAP_MAGIC)
+        header.append(_BITMAP_VERSION)
+        _encode_varint(len(bitmap.containers), header)
+        body = bytearray()
+        for key, container in sorted(bitmap.containers.items()):
+            _encode_varint(key, header)
+            _encode_varint(_cardinality(container), header)
+            if isinstance(container, int):
+                body.extend(container.to_bytes(_BITMAP_CONTAINER_BYTES, 'little'))
+            else:
+                if sys.byteorder == 'big':
+                    container = array('H', container)
+                    container.byteswap()
+                body.extend(container.tobytes())
+        return bytes(header + body)
+
+    @log
+    @timed('decode')
+    def decode(self, blob):
+        if blob[0:len(_BITMAP_MAGIC)] != _BITMAP_MAGIC:
+            return DocumentBitmap(self._posting_list_codec.decode(blob).document_ids)
+        data = memoryview(blob)
+        if data[len(_BITMAP_MAGIC)] != _BITMAP_VERSION:
+            raise ValueError('Unsupported bitmap version: {0}'.format(data[len(_BITMAP_MAGIC)]))
+        (number_of_containers,), offset = _decode_varints(data, len(_BITMAP_MAGIC) + 1, 1)
+        header, offset = _decode_varints(data, offset, number_of_containers * 2)
+        containers = {}
+        for key, cardinality in zip(header[0::2], header[1::2]):
+            if cardinality > _BITMAP_ARRAY_LIMIT:
+                containers[key] = int.from_bytes(data[offset:offset + _BITMAP_CONTAINER_BYTES], 'little')
+                offset += _BITMAP_CONTAINER_BYTES
+            else:
+                container = array('H')
+                container.frombytes(data[offset:offset + 2 * cardinality])
+                if sys.byteorder == 'big':
+                    container.byteswap()
+                containers[key] = container
+                offset += 2 * cardinality
+        return DocumentBitmap(containers = containers)
+
+    @log
+    def exclude(self, bitmap, document_ids):
+        if len(document_ids.containers) == 0:
+            return bitmap
+        return bitmap - document_ids
+
+    @log
+    def union(self, bitmaps):
+        bitmap = bitmaps[0]
+        for other in bitmaps[1:]:
+            bitmap = bitmap | other
+        return bitmap
+
+class PostingListCodec(object):
+    @log
+    def encode(self, posting_list):
+        document_ids = sorted(posting_list)
+        header = bytearray(_POSTING_LIST_MAGIC)
+        header.append(_POSTING_LIST_VERSION)
+        _encode_varint(len(document_ids), header)
+        counts = bytearray()
+        lengths = bytearray()
+        body = bytearray()
+        prev_document_id = 0
+        for document_id in document_ids:
+            _encode_varint(document_id - prev_document_id, header)
+            prev_document_id = document_id
+            positions = sorted(posting_list[document_id])
+            _encode_varint(len(positions), counts)
+            start = len(body)
+            prev_position = 0
+            for position in positions:
+                _encode_varint(position - prev_position, body)
+                prev_position = position
+            _encode_varint(len(body) - start, lengths)
+        return bytes(header + counts + lengths + body)
+
+    @log
+    @timed('decode')
+    def decode(self, blob):
+        if not self.is_encoded(blob):
+            return self.decode(self.encode(loads(blob).posting_list))
+        data = memoryview(blob)
+        if data[len(_POSTING_LIST_MAGIC)] != _POSTING_LIST_VERSION:
+            raise ValueError('Unsupported posting list version: {0}'.format(data[len(_POSTING_LIST_MAGIC)]))
+        number_of_documents, offset = _decode_varints(data, len(_POSTING_LIST_MAGIC) + 1, 1)
+        number_of_documents = number_of_documents[0]
+        document_ids, offset = _decode_varints(data, offset, number_of_documents)
+        document_id = 0
+        for i, delta in enumerate(document_ids):
+            document_id += delta
+            document_ids[i] = document_id
+        positions_counts, offset = _decode_varints(data, offset, number_of_documents)
+        lengths, offset = _decode_varints(data, offset, number_of_documents)
+        offsets = array('q')
+        for length in lengths:
+            offsets.append(offset)
+            offset += length
+        return PostingList(document_ids, positions_counts, offsets, data)
+
+    @log
+    def union(self, posting_lists):
+        if len(posting_lists) == 1:
+            return posting_lists[0]
+        return MergedPostingList(posting_lists)
+
+    @log
+    def exclude(self, posting_list, document_ids):
+        if len(document_ids.containers) == 0:
+            return posting_list
+        return MergedPostingList([posting_list], document_ids)
+
+    def is_encoded(self, blob):
+        return blob[0:len(_POSTING_LIST_MAGIC)] == _POSTING_LIST_MAGIC
+
+def _intersect_document_ids(document_ids, other_document_ids):
+    if len(document_ids) > len(other_document_ids):
+        document_ids, other_document_ids = other_document_ids, document_ids
+    intersection = array('q')
+    low = 0
+    length = len(other_document_ids)
+    for document_id in document_ids:
+        step = 1
+        while low + step < length and other_document_ids[low + step] < document_id:
+            step = step * 2
+        low = bisect_left(other_document_ids, document_id, low, min(low + step + 1, length))
+        if low == length:
+            break
+        if other_document_ids[low] == document_id:
+            intersection.append(document_id)
+            low = low + 1
+    return intersection
+
+class _LRUCache(object):
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._size = 0
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key, generation, default = None):
+        with self._lock:
+            self._validate(generation)
+            entry = self._entries.get(key)
+            if entry == None:
+                self.misses = self.misses + 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[0]
+
+    def _put(self, key, value, size, generation):
+        if generation == None or size > self._capacity:
+            return
+        with self._lock:
+            self._validate(generation)
+            if key in self._entries:
+                self._size = self._size - self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size = self._size + size
+            while self._size > self._capacity:
+                evicted_key, (evicted, evicted_size) = self._entries.popitem(last = False)
+                self._size = self._size - evicted_size
+                self.evictions = self.evictions + 1
+
+    def _validate(self, generation):
+        if generation == None or generation != self._generation:
+            self._entries.clear()
+            self._size = 0
+            self._generation = generation
+
+    @log
+    def statistics(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self._size, 'generation': self._generation}
+
+class PostingListCache(_LRUCache):
+    @log
+    def __init__(self, capacity = _POSTING_LIST_CACHE_SIZE):
+        _LRUCache.__init__(self, capacity)
+
+    @log
+    def get(self, token, generation):
+        return self._get(token, generation)
+
+    @log
+    def put(self, token, posting_list, generation):
+        self._put(token, posting_list, posting_list.size + _CACHE_ENTRY_OVERHEAD, generation)
+
+class QueryResultCache(_LRUCache):
+    @log
+    def __init__(self, capacity = _QUERY_RESULT_CACHE_SIZE):
+        _LRUCache.__init__(self, capacity)
+
+    @log
+    def search(self, search, queries, parameters, generation):
+        keys = [(_normalize_query(words),) + parameters for words in queries]
+        results = {}
+        for key in keys:
+            if key not in results:
+                results[key] = self._get(key, generation, _MISSING)
+        missing_keys = [key for key, search_results in results.items() if search_results is _MISSING]
+        if len(missing_keys) > 0:
+            for key, search_results in zip(missing_keys, search([key[0] for key in missing_keys])):
+                results[key] = search_results
+                self._put(key, _copy_results(search_results), _result_size(key, search_results), generation)
+        return [_copy_results(results[key]) for key in keys]
+
+def _normalize_query(words):
+    return ' '.join(split('\s+', words.strip(' 　')))
+
+def _result_size(key, search_results):
+    size = _CACHE_ENTRY_OVERHEAD + sys.getsizeof(key[0])
+    for document in search_results or []:
+        size = size + _CACHE_ENTRY_OVERHEAD + sum(sys.getsizeof(value) for value in document)
+    return size
+
+def _copy_results(search_results):
+    if search_results == None or search_results is _MISSING:
+        return search_results
+    return [list(document) for document in search_results]
+
+class ConnectionPool(object):
+    @log
+    def __init__(self, database_file, size = _CONNECTION_POOL_SIZE):
+        self._database_file = database_file
+        self._size = size
+        self._connections = LifoQueue()
+        self._lock = Lock()
+        self._created = 0
+
+    @contextmanager
+    def connection(self):
+        connection, inode = self._acquire()
+        if inode != self._inode():
+            connection.close()
+            connection, inode = self._connect()
+        try:
+            yield connection
+        finally:
+            self._connections.put((connection, inode))
+
+    @log
+    def _acquire(self):
+        try:
+            return self._connections.get_nowait()
+        except Empty:
+            with self._lock:
+                if self._created < self._size:
+                    self._created = self._created + 1
+                    return self._connect()
+            return self._connections.get()
+
+    @log
+    def _connect(self):
+        inode = self._inode()
+        connection = connect(self._database_file, isolation_level = None, check_same_thread = False, timeout = _BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        return connection, inode
+
+    def _inode(self):
+        try:
+            return os.stat(self._database_file).st_ino
+        except OSError:
+            return None
+
+    @log
+    def close(self):
+        with self._lock:
+            while self._created > 0:
+                self._connections.get()[0].close()
+                self._created = self._created - 1
+
+class Searcher(object):
+    @log
+    def __init__(self, database_file, memory_mode, tokenizer_type, cache_size = _POSTING_LIST_CACHE_SIZE, result_cache_size = _QUERY_RESULT_CACHE_SIZE):
+        self._database_file = database_file
+        self._memory_mode = memory_mode
+        self._frozen_index = FrozenIndex(database_file) if _is_frozen_index(database_file) else None
+        if self._frozen_index != None:
+            tokenizer_type = self._frozen_index.tokenizer_type
+        self._tokenizer_type = tokenizer_type
+        self._tokenizer = TokenizerFactory().create_tokenizer(tokenizer_type)
+        self._codec = PostingListCodec()
+        self._bitmap_codec = DocumentBitmapCodec()
+        self._documents = DocumentStore()
+        self._pool = ConnectionPool(database_file)
+        self._cache = PostingListCache(cache_size)
+        self._results = QueryResultCache(result_cache_size)
+        self._schema_version = 0
+        self._tombstones = (None, _Tombstones([]))
+
+    @log
+    @timed('search')
+    def search(self, words, return_content = False, limit = None, offset = 0, snippet_size = None):
+        return self.search_batch([words], return_content, limit, offset, snippet_size)[0]
+
+    @log
+    @timed('search_batch')
+    def search_batch(self, queries, return_content = False, limit = None, offset = 0, snippet_size = None):
+        return self._results.search(lambda queries: self._search_batch(queries, return_content, limit, offset, snippet_size), queries, (self._tokenizer_type, return_content, limit, offset, snippet_size), self._get_generation())
+
+    @log
+    def _search_batch(self, queries, return_content = False, limit = None, offset = 0, snippet_size = None):
+        search_results = []
+        for words, (matched_document_ids, frequencies, metadata) in zip(queries, self._match_batch(queries)):
+            if matched_document_ids == None:
+                search_results.append(None)
+                continue
+            ranked = self._rank(matched_document_ids, frequencies, metadata, None if limit == None else offset + limit)
+            search_results.append(self._get_documents([document_id for score, document_id in ranked[offset:]], return_content, words, snippet_size))
+        return search_results
+
+    @log
+    @timed('match')
+    def _match_batch(self, queries):
+        parsed = [self._parse(words) for words in queries]
+        bitmaps, metadata = self._get_bitmaps({token for clauses in parsed for token in self._filtered_tokens(clauses)})
+        filtered = [self._filter(clauses, bitmaps, metadata) for clauses in parsed]
+        tokens = {token for clauses, (candidates, exact, metadata) in zip(parsed, filtered) if candidates != None and len(candidates) > 0 for token in self._verified_tokens(clauses)}
+        posting_lists, posting_metadata = self._get_posting_lists(tokens) if len(tokens) > 0 else ({}, metadata)
+        matches = []
+        for clauses, (candidates, exact, metadata) in zip(parsed, filtered):
+            if candidates == None:
+                matches.append((None, self._unmatched_frequencies(clauses, bitmaps), metadata))
+            elif len(candidates) == 0:
+                matches.append((candidates.to_array(), self._unmatched_frequencies(clauses, bitmaps), metadata))
+            else:
+                matches.append(self._verify(clauses, candidates, posting_metadata, posting_lists))
+        return matches
+
+    def _unmatched_frequencies(self, clauses, sizes):
+        return [([([len(sizes[token]) if token in sizes else 0 for i, token in tokens], False) for tokens in alternatives], {}) for negated, alternatives in clauses if not negated]
+
+    @log
+    def count(self, words):
+        clauses = self._parse(words)
+        candidates, exact, metadata = self._filter(clauses)
+        if candidates == None:
+            return 0
+        if exact:
+            return len(candidates)
+        return len(self._verify(clauses, candidates, metadata)[0])
+
+    @log
+    def _parse(self, words):
+        clauses = []
+        alternative = False
+        for word in split('\s+', words.strip(' 　')):
+            if word == 'OR' and len(clauses) > 0 and not clauses[-1][0]:
+                alternative = True
+                continue
+            negated = len(word) > 1 and word[0] == '-'
+            tokens = self._tokenizer.tokenize(word[1:] if negated else word)
+            if alternative and not negated:
+                clauses[-1][1].append(tokens)
+            else:
+                clauses.append((negated, [tokens]))
+            alternative = False
+        return clauses
+
+    def _filtered_tokens(self, clauses):
+        return {token for negated, alternatives in clauses for tokens in alternatives for i, token in tokens}
+
+    def _verified_tokens(self, clauses):
+        return {token for negated, alternatives in clauses for tokens in alternatives if not negated or len(tokens) > 1 for i, token in tokens}
+
+    @log
+    def _filter(self, clauses, bitmaps = None, metadata = None):
+        if bitmaps == None:
+            bitmaps, metadata = self._get_bitmaps(self._filtered_tokens(clauses))
+        candidates = None
+        exact = True
+        for negated, alternatives in sorted(clauses, key = lambda clause: clause[0]):
+            if negated and candidates == None:
+                return None, exact, metadata
+            if not negated and not any(token in bitmaps for tokens in alternatives for i, token in tokens):
+                return None, exact, metadata
+            for tokens in alternatives:
+                exact = exact and len(tokens) <= 1
+                if negated and len(tokens) == 1:
+                    candidates = candidates - bitmaps.get(tokens[0][1], DocumentBitmap())
+            if not negated:
+                clause = None
+                for tokens in alternatives:
+                    bitmap = self._intersect_bitmaps(bitmaps, tokens)
+                    clause = bitmap if clause == None else clause | bitmap
+                candidates = clause if candidates == None else candidates & clause
+        return candidates, exact, metadata
+
+    def _intersect_bitmaps(self, bitmaps, tokens):
+        if len(tokens) == 0 or any(token not in bitmaps for i, token in tokens):
+            return DocumentBitmap()
+        tokens = sorted({token for i, token in tokens}, key = lambda token: len(bitmaps[token].containers))
+        bitmap = bitmaps[tokens[0]]
+        for token in tokens[1:]:
+            bitmap = bitmap & bitmaps[token]
+        return bitmap
+
+    @log
+    def _verify(self, clauses, candidates, metadata, posting_lists = None):
+        frequencies = []
+        matched_document_ids = candidates.to_array()
+        if len(matched_document_ids) == 0:
+            return matched_document_ids, frequencies, metadata
+        if posting_lists == None:
+            posting_lists, metadata = self._get_posting_lists(self._verified_tokens(clauses))
+        for negated, alternatives in sorted(clauses, key = lambda clause: not clause[0]):
+            if negated:
+                for tokens in alternatives:
+                    if len(tokens) > 1:
+                        excluded = self._get_phrase_frequencies(posting_lists, tokens, matched_document_ids)
+                        matched_document_ids = array('q', [document_id for document_id in matched_document_ids if document_id not in excluded])
+                continue
+            phrase_frequencies = {}
+            document_frequencies = []
+            for tokens in alternatives:
+                word_frequencies = self._get_phrase_frequencies(posting_lists, tokens, matched_document_ids) if len(matched_document_ids) > 0 else {}
+                for document_id, frequency in word_frequencies.items():
+                    phrase_frequencies[document_id] = phrase_frequencies.get(document_id, 0) + frequency
+                document_frequencies.append(([len(posting_lists[token]) if token in posting_lists else 0 for i, token in tokens], len(word_frequencies) > 0))
+            frequencies.append((document_frequencies, phrase_frequencies))
+            matched_document_ids = array('q', sorted(phrase_frequencies))
+        return matched_document_ids, frequencies, metadata
+
+    @log
+    @timed('rank')
+    def _rank(self, matched_document_ids, frequencies, metadata, limit = None):
+        if len(matched_document_ids) == 0:
+            return []
+        lengths = self._get_document_lengths(matched_document_ids)
+        number_of_documents = max(metadata.get('document_count', 0), len(matched_document_ids))
+        average_length = metadata.get('total_length', 0) / metadata['document_count'] if metadata.get('document_count', 0) > 0 else 1
+        weights = [logarithm(1 + (max(number_of_documents, document_frequency) - document_frequency + 0.5) / (document_frequency + 0.5)) for document_frequency in (_document_frequency(document_frequencies) for document_frequencies, phrase_frequencies in frequencies)]
+        scores = []
+        for document_id in matched_document_ids:
+            normalizer = _BM25_K1 * (1 - _BM25_B + _BM25_B * lengths.get(document_id, average_length) / average_length)
+            score = 0
+            for weight, (document_frequencies, phrase_frequencies) in zip(weights, frequencies):
+                frequency = phrase_frequencies[document_id]
+                score = score + weight * frequency * (_BM25_K1 + 1) / (frequency + normalizer)
+            scores.append((score, -document_id))
+        if limit == None:
+            ranked = sorted(scores, reverse = True)
+        else:
+            ranked = heapq.nlargest(limit, scores)
+        return [(score, -document_id) for score, document_id in ranked]
+
+    @log
+    @timed('posting_fetch')
+    def _get_posting_lists(self, tokens):
+        if self._frozen_index != None:
+            return self._get_frozen_posting_lists(tokens)
+        return self._fetch(tokens, 'posting_list', self._codec)
+
+    @log
+    @timed('bitmap_fetch')
+    def _get_bitmaps(self, tokens):
+        if self._frozen_index != None:
+            posting_lists, metadata = self._get_frozen_posting_lists(tokens)
+            bitmaps = {}
+            for token, posting_list in posting_lists.items():
+                bitmaps[token] = self._cache.get(('bitmap', token), metadata['generation'])
+                if bitmaps[token] == None:
+                    bitmaps[token] = DocumentBitmap(posting_list.document_ids)
+                    self._cache.put(('bitmap', token), bitmaps[token], metadata['generation'])
+            return bitmaps, metadata
+        return self._fetch(tokens, 'bitmap', self._bitmap_codec)
+
+    @log
+    def _fetch(self, tokens, column, codec):
+        values = {}
+        metadata = {}
+        if len(tokens) == 0:
+            return values, metadata
+        with self._pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                self._read_schema_version(cursor)
+                if self._schema_version >= 3:
+                    cursor.execute('SELECT key, value FROM metadata')
+                    metadata = dict(cursor.fetchall())
+                generation = metadata.get('generation')
+                missing_tokens = []
+                for token in tokens:
+                    value = self._cache.get((column, token), generation) if generation != None else None
+                    if value != None:
+                        values[token] = [value]
+                    else:
+                        missing_tokens.append(token)
+                if len(missing_tokens) > 0:
+                    tombstones = self._get_tombstones(cursor, generation)
+                    cursor.execute('SELECT token, {0}, {1}, {2} FROM indices WHERE token IN (SELECT value FROM json_each(?)) ORDER BY {3}'.format('segment' if self._schema_version >= 2 else '0', column if self._schema_version >= 5 else 'posting_list', 'bitmap' if column != 'bitmap' and len(tombstones) > 0 else 'NULL', 'segment' if self._schema_version >= 2 else 'rowid'), (json.dumps(missing_tokens),))
+                    for token, segment, blob, bitmap in cursor.fetchall():
+                        value = codec.decode(blob)
+                        if len(tombstones) > 0:
+                            value = codec.exclude(value, tombstones.excluded(segment, value if bitmap == None else self._bitmap_codec.decode(bitmap)))
+                        values.setdefault(token, []).append(value)
+            finally:
+                connection.commit()
+        values = {token: codec.union(value) for token, value in values.items()}
+        if generation != None:
+            for token in missing_tokens:
+                if token in values:
+                    self._cache.put((column, token), values[token], generation)
+        return values, metadata
+
+    def _read_schema_version(self, cursor):
+        if self._schema_version < _SCHEMA_VERSION:
+            cursor.execute('PRAGMA user_version')
+            self._schema_version = cursor.fetchone()[0]
+
+    @log
+    def _get_generation(self):
+        if self._frozen_index != None:
+            return self._frozen_index.metadata['generation']
+        with self._pool.connection() as connection:
+            cursor = connection.cursor()
+            self._read_schema_version(cursor)
+            if self._schema_version < 3:
+                return None
+            cursor.execute("SELECT value FROM metadata WHERE key = 'generation'")
+            row = cursor.fetchone()
+        return row[0] if row != None else None
+
+    @log
+    def _get_tombstones(self, cursor, generation):
+        if self._schema_version < 7:
+            return self._tombstones[1]
+        if generation == None or self._tombstones[0] != generation:
+            cursor.execute('SELECT document_id, segment FROM tombstones')
+            self._tombstones = (generation, _Tombstones(cursor.fetchall()))
+        return self._tombstones[1]
+
+    @log
+    def _get_frozen_posting_lists(self, tokens):
+        posting_lists = {}
+        metadata = self._frozen_index.metadata
+        for token in tokens:
+            posting_list = self._cache.get(('posting_list', token), metadata['generation'])
+            if posting_list == None:
+                blob = self._frozen_index.posting_list(token)
+                if blob == None:
+                    continue
+                posting_list = self._codec.decode(blob)
+                self._cache.put(('posting_list', token), posting_list, metadata['generation'])
+            posting_lists[token] = posting_list
+        return posting_lists, metadata
+
+    @log
+    def _get_document_lengths(self, document_ids):
+        if self._frozen_index != None:
+            lengths = {}
+            for document_id in document_ids:
+                document = self._frozen_index.document(document_id)
+                if document != None and document[2] != None:
+                    lengths[document_id] = document[2]
+            return lengths
+        if self._schema_version < 4:
+            return {}
+        with self._pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute('SELECT id, length FROM documents WHERE id IN (SELECT value FROM json_each(?)) AND length IS NOT NULL', (json.dumps(list(document_ids)),))
+            return dict(cursor.fetchall())
+
+    @log
+    def cache_statistics(self):
+        return self._cache.statistics()
+
+    @log
+    def result_cache_statistics(self):
+        return self._results.statistics()
+
+    @log
+    def _get_matched_document_ids(self, posting_lists, tokens, prev_matched_document_ids = None):
+        return list(self._get_phrase_frequencies(posting_lists, tokens, prev_matched_document_ids))
+
+    @log
+    def _get_phrase_frequencies(self, posting_lists, tokens, prev_matched_document_ids = None):
+        if len(tokens) == 0 or any(token not in posting_lists for i, token in tokens):
+            return {}
+        tokens = sorted(tokens, key = lambda token: len(posting_lists[token[1]]))
+        matched_document_ids = prev_matched_document_ids
+        for i, token in tokens:
+            if matched_document_ids == None:
+                matched_document_ids = posting_lists[token].document_ids
+            else:
+                matched_document_ids = _intersect_document_ids(matched_document_ids, posting_lists[token].document_ids)
+            if len(matched_document_ids) == 0:
+                return {}
+        frequencies = {}
+        if len(tokens) == 1:
+            posting_list = posting_lists[tokens[0][1]]
+            for document_id in matched_document_ids:
+                frequencies[document_id] = posting_list.count(posting_list.find(document_id))
+            return frequencies
+        for document_id in matched_document_ids:
+            frequency = self._match_phrase(posting_lists, tokens, document_id)
+            if frequency > 0:
+                frequencies[document_id] = frequency
+        return frequencies
+
+    @log
+    def _match_phrase(self, posting_lists, tokens, document_id):
+        starts = None
+        for i, token in tokens:
+            posting_list = posting_lists[token]
+            shifted = {position - i for position in posting_list.positions(posting_list.find(document_id))}
+            starts = shifted if starts == None else starts & shifted
+            if len(starts) == 0:
+                return 0
+        return len(starts)
+
+    @log
+    @timed('document_fetch')
+    def _get_documents(self, matched_document_ids, return_content = False, words = None, snippet_size = None):
+        if len(matched_document_ids) == 0:
+            return []
+        documents = {}
+        if return_content:
+            positions = self._first_positions(words, matched_document_ids) if snippet_size != None else {}
+            for document_id, title, content, block in self._get_document_records(matched_document_ids):
+                if block != None:
+                    content = block
+                elif snippet_size != None:
+                    content = self._documents.read(content, max(0, positions.get(document_id, 0) - len(title)) + snippet_size)
+                else:
+                    content = self._documents.read(content)
+                documents[document_id] = [document_id, title, _snippet(title, content, positions.get(document_id, 0), snippet_size) if snippet_size != None else content]
+        elif self._frozen_index != None:
+            for document_id in matched_document_ids:
+                document = self._frozen_index.document(document_id)
+                if document != None:
+                    documents[document_id] = [document_id, document[0]]
+        else:
+            with self._pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute('SELECT id, title FROM documents WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(list(matched_document_ids)),))
+                documents = {id: [id, title] for id, title in cursor.fetchall()}
+        return [documents[document_id] for document_id in matched_document_ids if document_id in documents]
+
+    @log
+    def _get_document_records(self, document_ids):
+        if self._frozen_index != None:
+            records = []
+            for document_id in document_ids:
+                document = self._frozen_index.document(document_id)
+                if document != None:
+                    records.append((document_id, document[0], document[1], None))
+            return records
+        with self._pool.connection() as connection:
+            cursor = connection.cursor()
+            self._read_schema_version(cursor)
+            cursor.execute('SELECT id, title, content, {0} FROM documents WHERE id IN (SELECT value FROM json_each(?))'.format('block, block_index' if self._schema_version >= 6 else 'NULL, NULL'), (json.dumps(list(document_ids)),))
+            rows = cursor.fetchall()
+            blocks = {}
+            block_ids = list({block for document_id, title, content, block, block_index in rows if block != None})
+            if len(block_ids) > 0:
+                cursor.execute('SELECT id, data FROM blocks WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(block_ids),))
+                blocks = {block: self._documents.unpack_block(data) for block, data in cursor.fetchall()}
+        return [(document_id, title, content, blocks[block][block_index] if block != None else None) for document_id, title, content, block, block_index in rows]
+
+    @log
+    def _first_positions(self, words, document_ids):
+        posting_lists, metadata = self._get_posting_lists({token for negated, alternatives in self._parse(words) if not negated for tokens in alternatives for i, token in tokens})
+        positions = {}
+        for document_id in document_ids:
+            for posting_list in posting_lists.values():
+                index = posting_list.find(document_id)
+                if index >= 0:
+                    positions[document_id] = min(posting_list.positions(index)[0], positions.get(document_id, sys.maxsize))
+        return positions
+
+    @log
+    def close(self):
+        self._pool.close()
+        if self._frozen_index != None:
+            self._cache = PostingListCache(0)
+            self._frozen_index.close()
+
+def _document_frequency(document_frequencies):
+    return sum(min(sizes) for sizes, matched in document_frequencies if matched and len(sizes) > 0)
+
+def _is_frozen_index(database_file):
+    if not os.path.isfile(database_file):
+        return False
+    with open(database_file, 'rb') as f:
+        return f.read(len(_FROZEN_INDEX_MAGIC)) == _FROZEN_INDEX_MAGIC
+
+def _align(f):
+    f.write(bytes(-f.tell() % 8))
+    return f.tell()
+
+class FrozenIndexBuilder(object):
+    @log
+    def __init__(self, database_file, tokenizer_type):
+        self._database_file = database_file
+        self._tokenizer_type = tokenizer_type
+        self._codec = PostingListCodec()
+        self._documents = DocumentStore()
+
+    @log
+    def build(self, frozen_file):
+        if _is_shard_manifest(self._database_file):
+            raise ValueError('Cannot freeze a shard manifest, freeze each shard file instead: {0}'.format(self._database_file))
+        indexer = Indexer(self._database_file, False, self._tokenizer_type)
+        indexer.purge()
+        indexer.close_database_connection()
+        connection = connect(self._database_file)
+        token = connection.execute('SELECT token FROM indices LIMIT 1').fetchone()
+        if token != None and len(token[0]) != TokenizerFactory().create_tokenizer(self._tokenizer_type).size:
+            connection.close()
+            raise ValueError('Database is not indexed with the {0} tokenizer: {1}'.format(self._tokenizer_type, self._database_file))
+        temporary_file = frozen_file + '.tmp'
+        try:
+            with open(temporary_file, 'wb') as f:
+                f.write(bytes(_FROZEN_INDEX_HEADER.size))
+                postings_offset = _align(f)
+                terms = bytearray()
+                term_offsets = array('q', [0])
+                posting_offsets = array('q', [0])
+                cursor = connection.execute('SELECT token, posting_list FROM indices ORDER BY token, segment')
+                for token, rows in itertools.groupby(cursor, key = lambda row: row[0]):
+                    blobs = [blob for token, blob in rows]
+                    if len(blobs) > 1 or not self._codec.is_encoded(blobs[0]):
+                        posting_list = self._codec.union([self._codec.decode(blob) for blob in blobs]).to_dict()
+                        if len(posting_list) == 0:
+                            continue
+                        blobs = [self._codec.encode(posting_list)]
+                    f.write(blobs[0])
+                    posting_offsets.append(f.tell() - postings_offset)
+                    terms.extend(token.encode('utf-8'))
+                    term_offsets.append(len(terms))
+                documents_offset = _align(f)
+                document_ids = array('q')
+                document_offsets = array('q', [0])
+                blocks = {}
+                for document_id, title, content, length, block, block_index in connection.execute('SELECT id, title, content, length, block, block_index FROM documents ORDER BY id'):
+                    if block != None:
+                        if block not in blocks:
+                            blocks = {block: self._documents.unpack_block(connection.execute('SELECT data FROM blocks WHERE id = ?', (block,)).fetchone()[0])}
+                        content = self._documents.encode(blocks[block][block_index])
+                    record = bytearray()
+                    title = (title or '').encode('utf-8')
+                    _encode_varint(len(title), record)
+                    record.extend(title)
+                    _encode_varint(length + 1 if length != None else 0, record)
+                    f.write(record)
+                    f.write(content)
+                    document_ids.append(document_id)
+                    document_offsets.append(f.tell() - documents_offset)
+                metadata = dict(connection.execute('SELECT key, value FROM metadata').fetchall())
+                terms_offset = _align(f)
+                f.write(terms)
+                term_offsets_offset = _align(f)
+                f.write(term_offsets.tobytes())
+                posting_offsets_offset = f.tell()
+                f.write(posting_offsets.tobytes())
+                document_ids_offset = f.tell()
+                f.write(document_ids.tobytes())
+                document_offsets_offset = f.tell()
+                f.write(document_offsets.tobytes())
+                f.seek(0)
+                f.write(_FROZEN_INDEX_HEADER.pack(_FROZEN_INDEX_MAGIC, _FROZEN_INDEX_VERSION, _FROZEN_INDEX_BYTE_ORDER, len(term_offsets) - 1, len(document_ids), metadata.get('document_count', 0), metadata.get('total_length', 0), postings_offset, documents_offset, terms_offset, term_offsets_offset, posting_offsets_offset, document_ids_offset, document_offsets_offset, self._tokenizer_type.encode('ascii')))
+            os.replace(temporary_file, frozen_file)
+        finally:
+            connection.close()
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+        return len(term_offsets) - 1
+
+class FrozenIndex(object):
+    @log
+    def __init__(self, frozen_file):
+        with open(frozen_file, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        data = memoryview(self._mmap)
+        magic, version, byte_order, term_count, record_count, document_count, total_length, postings_offset, documents_offset, terms_offset, term_offsets_offset, posting_offsets_offset, document_ids_offset, document_offsets_offset, tokenizer_type = _FROZEN_INDEX_HEADER.unpack_from(data)
+        if magic != _FROZEN_INDEX_MAGIC or byte_order != _FROZEN_INDEX_BYTE_ORDER:
+            raise ValueError('Not a frozen index for this platform: {0}'.format(frozen_file))
+        if version != _FROZEN_INDEX_VERSION:
+            raise ValueError('Unsupported frozen index version: {0}'.format(version))
+        self.tokenizer_type = tokenizer_type.rstrip(b'\x00').decode('ascii')
+        self.metadata = {'generation': 0, 'document_count': document_count, 'total_length': total_length}
+        self._postings = data[postings_offset:documents_offset]
+        self._documents = data[documents_offset:terms_offset]
+        self._terms = data[terms_offset:term_offsets_offset]
+        self._term_offsets = data[term_offsets_offset:posting_offsets_offset].cast('q')
+        self._posting_offsets = data[posting_offsets_offset:document_ids_offset].cast('q')
+        self._document_ids = data[document_ids_offset:document_offsets_offset].cast('q')
+        self._document_offsets = data[document_offsets_offset:document_offsets_offset + 8 * (record_count + 1)].cast('q')
+        self._views = [data, self._postings, self._documents, self._terms, self._term_offsets, self._posting_offsets, self._document_ids, self._document_offsets]
+
+    def _term(self, index):
+        return self._terms[self._term_offsets[index]:self._term_offsets[index + 1]].tobytes()
+
+    @log
+    def posting_list(self, token):
+        term = token.encode('utf-8')
+        low = 0
+        high = len(self._term_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self._term_offsets) - 1 or self._term(low) != term:
+            return None
+        return self._postings[self._posting_offsets[low]:self._posting_offsets[low + 1]]
+
+    @log
+    def document(self, document_id):
+        index = bisect_left(self._document_ids, document_id)
+        if index == len(self._document_ids) or self._document_ids[index] != document_id:
+            return None
+        record = self._documents[self._document_offsets[index]:self._document_offsets[index + 1]]
+        (title_length,), offset = _decode_varints(record, 0, 1)
+        title = str(record[offset:offset + title_length], encoding = 'utf-8')
+        (length,), offset = _decode_varints(record, offset + title_length, 1)
+        return title, record[offset:], length - 1 if length > 0 else None
+
+    @log
+    def close(self):
+        for view in self._views:
+            view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+def _is_shard_manifest(database_file):
+    if not os.path.isfile(database_file) or _is_frozen_index(database_file):
+        return False
+    with open(database_file, 'rb') as f:
+        return f.read(1) == b'{'
+
+class ShardManifest(object):
+    @log
+    def __init__(self, manifest_file, tokenizer_type = None, number_of_shards = None):
+        self._manifest_file = manifest_file
+        with self._locked():
+            if os.path.exists(manifest_file):
+                self._load()
+            else:
+                if number_of_shards == None or number_of_shards < 1:
+                    raise ValueError('Number of shards is required to create a shard manifest.')
+                self.tokenizer_type = tokenizer_type
+                self._shards = ['{0}.shard{1}'.format(os.path.basename(manifest_file), i) for i in range(0, number_of_shards)]
+                self._next_document_id = 1
+                self.save()
+
+    @property
+    def shard_files(self):
+        directory = os.path.dirname(os.path.abspath(self._manifest_file))
+        return [os.path.join(directory, shard) for shard in self._shards]
+
+    def shard_of(self, document_id):
+        return document_id % len(self._shards)
+
+    @log
+    def allocate(self, count):
+        with self._locked():
+            self._load()
+            document_ids = range(self._next_document_id, self._next_document_id + count)
+            self._next_document_id = self._next_document_id + count
+            self.save()
+        return document_ids
+
+    @contextmanager
+    def _locked(self):
+        with open(self._manifest_file + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        with open(self._manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['version'] != _SHARD_MANIFEST_VERSION:
+            raise ValueError('Unsupported shard manifest version: {0}'.format(manifest['version']))
+        self.tokenizer_type = manifest['tokenizer']
+        self._shards = manifest['shards']
+        self._next_document_id = manifest['next_document_id']
+
+    @log
+    def save(self):
+        temporary_file = self._manifest_file + '.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump({'version': _SHARD_MANIFEST_VERSION, 'tokenizer': self.tokenizer_type, 'shards': self._shards, 'next_document_id': self._next_document_id}, f)
+        os.replace(temporary_file, self._manifest_file)
+
+class ShardedIndexer(object):
+    @log
+    def __init__(self, manifest_file, tokenizer_type, number_of_shards = None, memory_budget = _DEFAULT_MEMORY_BUDGET, compression = _DEFAULT_COMPRESSION):
+        self._manifest = ShardManifest(manifest_file, tokenizer_type, number_of_shards)
+        self._tokenizer_type = self._manifest.tokenizer_type
+        self._memory_budget = memory_budget / len(self._manifest.shard_files)
+        self._compression = compression
+        self._indexers = {}
+
+    @log
+    def add_index(self, title, content):
+        return self.add_documents([(title, content)])[0]
+
+    @log
+    def add_documents(self, documents):
+        document_ids = self._manifest.allocate(len(documents))
+        for shard, (shard_documents, shard_document_ids) in self._route(documents, document_ids).items():
+            self._indexer(shard).add_documents(shard_documents, shard_document_ids)
+        return list(document_ids)
+
     @log
-    def __init__(self):
-        self.stopwords = compile(r'[\s,.!?"\'$%&\-+=/#:;{}\[\]()<>\^~_→｡@･ﾞ､｢｣…★☆♭\\–▼♪⇔♥°‐――≠※∞◇×、。（）：；「」『』【】［］｛｝〈〉《》〔〕〜～�｜｀＼＠？！”＃＄％＆’＝＋＊＜＞＿＾￥／，・´ ▽ ．－￤]')
+    def update_documents(self, documents):
+        routed = self._route(documents, [document_id for document_id, title, content in documents])
+        return [document_id for shard, (shard_documents, shard_document_ids) in routed.items() for document_id in self._indexer(shard).update_documents(shard_documents)]
 
     @log
-    def tokenize(self, title, content):
-        raise NotImplementedError("tokenize method must be overridden and implemented by a descendant class.")
+    def delete_documents(self, document_ids):
+        routed = self._route(document_ids, document_ids)
+        return [document_id for shard, (shard_documents, shard_document_ids) in routed.items() for document_id in self._indexer(shard).delete_documents(shard_document_ids)]
 
-class BigramTokenizer(Tokenizer):
     @log
-    def tokenize(self, title, content = ''):
-        document = ''.join([title, content])
-        tokens = []
-        for i in range(0, len(document)):
-            token = document[i:i+2]
-            if len(token) == 2 and self.stopwords.search(token) == None:
-                tokens.append((i, token))
-        return tokens
+    def purge(self):
+        return sum(self._indexer(shard).purge() for shard in range(0, len(self._manifest.shard_files)))
 
-class TrigramTokenizer(Tokenizer):
     @log
-    def tokenize(self, title, content = ''):
-        document = ''.join([title, content])
-        tokens = []
-        for i in range(0, len(document)):
-            token = document[i:i+3]
-            if len(token) == 3 and self.stopwords.search(token) == None:
-                tokens.append((i, token))
-        return tokens
+    def _indexer(self, shard):
+        if shard not in self._indexers:
+            self._indexers[shard] = Indexer(self._manifest.shard_files[shard], False, self._tokenizer_type, self._memory_budget, compression = self._compression)
+        return self._indexers[shard]
 
-class TokenizerFactory(object):
     @log
-    def create_tokenizer(self, tokenizer):
-        module = __import__("falcon")
-        class_name = tokenizer + 'Tokenizer'
-        clazz = None
-        try:
-            clazz = getattr(module, class_name)
-        except AttributeError:
-            print(class_name + ' is not implemented.')
-            exit(1)
-        return clazz()
+    def add_files(self, file_names, processes = None):
+        self.close_database_connection()
+        shard_files = self._manifest.shard_files
+        with Pool(processes or len(shard_files)) as pool:
+            for documents in _read_documents(file_names, _BULK_CHUNK_SIZE * len(shard_files)):
+                routed = self._route(documents, self._manifest.allocate(len(documents)))
+                pool.starmap(_index_shard, [(shard_files[shard], self._tokenizer_type, shard_documents, shard_document_ids, self._memory_budget, self._compression) for shard, (shard_documents, shard_document_ids) in routed.items()])
 
-class Indexer(object):
     @log
-    def __init__(self, database_file, memory_mode, tokenizer_type):
-        self._database_file = database_file
-        self._memory_mode = memory_mode
-        self._tokenizer = TokenizerFactory().create_tokenizer(tokenizer_type)
-        self._inverted_index = {}
-        self._connection = connect(self._database_file if not self._memory_mode else ':memory:', isolation_level = 'DEFERRED')
-        cursor = self._connection.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS indices (
-                  token TEXT PRIMARY KEY
-                , posting_list BLOB
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS documents (
-                  id INTEGER PRIMARY KEY
-                , title TEXT
-                , content BLOB
-            )
-        """)
-        self._connection.execute("PRAGMA journal_mode = OFF")
-        self._connection.execute("PRAGMA synchronous = OFF")
+    def _route(self, documents, document_ids):
+        routed = {}
+        for document, document_id in zip(documents, document_ids):
+            shard_documents, shard_document_ids = routed.setdefault(self._manifest.shard_of(document_id), ([], []))
+            shard_documents.append(document)
+            shard_document_ids.append(document_id)
+        return routed
+
+    @contextmanager
+    def savepoint(self):
+        with ExitStack() as stack:
+            for shard in range(0, len(self._manifest.shard_files)):
+                stack.enter_context(self._indexer(shard).savepoint())
+            yield
 
     @log
-    def add_index(self, title, content, document_id = 0):
-        if(document_id == 0):
-            document_id = self._store_document(title, content)
-        self._create_posting_list(document_id, title, content)
-        self._flush_buffer()
+    def flush(self):
+        for indexer in self._indexers.values():
+            indexer.flush()
 
     @log
-    def _store_document(self, title, content):
-        cursor = self._connection.cursor()
-        compressed = compress(content.encode('utf-8'), _COMPRESS_LEVEL)
-        cursor.execute('INSERT INTO documents (title, content) VALUES(?, ?)', (title, compressed))
-        lastrowid = cursor.lastrowid
-        return lastrowid
-
-    @log
-    def _create_posting_list(self, document_id, title, content):
-        tokens_exist = {i: token for i, token in self._tokenizer.tokenize(title, content) if token in self._inverted_index}
-        tokens_not_exist = {i: token for i, token in self._tokenizer.tokenize(title, content) if token not in self._inverted_index}
-        for i, token in tokens_exist.items():
-            inverted_index_hash = self._inverted_index[token]
-            inverted_index_hash.add(document_id, i)
-        cursor = self._connection.cursor()
-        cursor.execute('SELECT posting_list FROM indices WHERE token IN("{0}")'.format('", "'.join(str(token) for token in tokens_not_exist.values())))
-        rows = cursor.fetchall()
-        for row in rows:
-            unpickled = loads(row[0])
-            self._inverted_index[unpickled.token] = unpickled
-        for i, token in tokens_not_exist.items():
-            if token in self._inverted_index:
-                inverted_index_hash = self._inverted_index[token]
-                inverted_index_hash.add(document_id, i)
-            else:
-                self._inverted_index[token] = InvertedIndexHash(token, document_id, i)
+    def close_database_connection(self):
+        for indexer in self._indexers.values():
+            indexer.close_database_connection()
+        self._indexers = {}
 
+class ShardedSearcher(object):
     @log
-    def _flush_buffer(self, final = False):
-        total_number_positions = sum([item.positions_count for token, item in self._inverted_index.items()])
-        if final or total_number_positions > _TOKEN_POSITION_LIMIT:
-            cursor = self._connection.cursor()
-            cursor.executemany('INSERT OR REPLACE INTO indices (token, posting_list) VALUES (?, ?)', [(k, dumps(v)) for k, v in self._inverted_index.items()])
-            self._inverted_index = None
-            del self._inverted_index
-            gc.collect()
-            self._inverted_index = {}
+    def __init__(self, manifest_file, memory_mode, tokenizer_type, cache_size = _POSTING_LIST_CACHE_SIZE, result_cache_size = _QUERY_RESULT_CACHE_SIZE):
+        self._manifest = ShardManifest(manifest_file)
+        shard_files = self._manifest.shard_files
+        self._searchers = [Searcher(shard_file, memory_mode, self._manifest.tokenizer_type, cache_size // len(shard_files), 0) for shard_file in shard_files]
+        self._executor = ThreadPoolExecutor(len(shard_files))
+        self._results = QueryResultCache(result_cache_size)
 
     @log
-    def flush_memory_to_file(self):
-        self._connection.commit()
-        cursor = self._connection.cursor()
-        cursor.execute("attach '{0}' as __extdb".format(self._database_file))
-        cursor.execute("select name from sqlite_master where type='table'")
-        table_names = cursor.fetchall()
-        for table_name, in table_names:
-            cursor.execute("create table __extdb.{0} as select * from {1}".format(table_name, table_name))
-        cursor.execute("detach __extdb")
+    def search(self, words, return_content = False, limit = None, offset = 0, snippet_size = None):
+        return self.search_batch([words], return_content, limit, offset, snippet_size)[0]
 
     @log
-    def close_database_connection(self):
-        self._flush_buffer(True)
-        self._connection.commit()
-        self._connection.close()
+    def search_batch(self, queries, return_content = False, limit = None, offset = 0, snippet_size = None):
+        generations = tuple(self._executor.map(lambda searcher: searcher._get_generation(), self._searchers))
+        return self._results.search(lambda queries: self._search_batch(queries, return_content, limit, offset, snippet_size), queries, (self._manifest.tokenizer_type, return_content, limit, offset, snippet_size), generations if None not in generations else None)
 
-class InvertedIndexHash(object):
     @log
-    def __init__(self, token, document_id, position):
-        self.token = token
-        self.posting_list = {}
-        self.posting_list[document_id] = [position]
-        self.positions_count = 1
+    def _search_batch(self, queries, return_content = False, limit = None, offset = 0, snippet_size = None):
+        shard_matches = list(self._executor.map(lambda searcher: searcher._match_batch(queries), self._searchers))
+        return [self._search(words, [matches[i] for matches in shard_matches], return_content, limit, offset, snippet_size) for i, words in enumerate(queries)]
 
     @log
-    def add(self, document_id, position):
-        if document_id in self.posting_list:
-            self.posting_list[document_id].append(position)
-            self.positions_count = self.positions_count + 1
+    def _search(self, words, matches, return_content = False, limit = None, offset = 0, snippet_size = None):
+        top = None if limit == None else offset + limit
+        if all(matched_document_ids == None for matched_document_ids, frequencies, metadata in matches):
+            return None
+        statistics = {'document_count': 0, 'total_length': 0}
+        document_frequencies = None
+        for matched_document_ids, frequencies, metadata in matches:
+            for key in statistics:
+                statistics[key] = statistics[key] + metadata.get(key, 0)
+            shard_frequencies = [clause for clause, phrase_frequencies in frequencies]
+            if document_frequencies == None:
+                document_frequencies = shard_frequencies
+            else:
+                document_frequencies = [[(list(map(add, sizes, shard_sizes)), matched or shard_matched) for (sizes, matched), (shard_sizes, shard_matched) in zip(clause, shard_clause)] for clause, shard_clause in zip(document_frequencies, shard_frequencies)]
+        ranks = []
+        for searcher, (matched_document_ids, frequencies, metadata) in zip(self._searchers, matches):
+            if matched_document_ids != None:
+                frequencies = [(clause, phrase_frequencies) for clause, (shard_clause, phrase_frequencies) in zip(document_frequencies, frequencies)]
+                ranks.append((searcher, matched_document_ids, frequencies))
+        results = self._executor.map(lambda rank: rank[0]._rank(rank[1], rank[2], statistics, top), ranks)
+        candidates = (result for shard_results in results for result in shard_results)
+        if top == None:
+            ranked = sorted(candidates, key = lambda result: (result[0], -result[1]), reverse = True)
         else:
-            self.posting_list[document_id] = [position]
-            self.positions_count = self.positions_count + 1
+            ranked = heapq.nlargest(top, candidates, key = lambda result: (result[0], -result[1]))
+        document_ids = [document_id for score, document_id in ranked[offset:]]
+        routed = {}
+        for document_id in document_ids:
+            routed.setdefault(self._manifest.shard_of(document_id), []).append(document_id)
+        documents = {}
+        for shard_documents in self._executor.map(lambda shard: self._searchers[shard]._get_documents(routed[shard], return_content, words, snippet_size), list(routed)):
+            for document in shard_documents:
+                documents[document[0]] = document
+        return [documents[document_id] for document_id in document_ids if document_id in documents]
+
+    @log
+    def count(self, words):
+        return sum(self._executor.map(lambda searcher: searcher.count(words), self._searchers))
 
-class Searcher(object):
     @log
-    def __init__(self, database_file, memory_mode, tokenizer_type):
+    def cache_statistics(self):
+        return [searcher.cache_statistics() for searcher in self._searchers]
+
+    @log
+    def result_cache_statistics(self):
+        return self._results.statistics()
+
+    @log
+    def close(self):
+        self._executor.shutdown()
+        for searcher in self._searchers:
+            searcher.close()
+
+class IndexWriter(object):
+    @log
+    def __init__(self, database_file, tokenizer_type, interval = _GROUP_COMMIT_INTERVAL, batch_size = _GROUP_COMMIT_SIZE):
         self._database_file = database_file
-        self._memory_mode = memory_mode
-        self._tokenizer = TokenizerFactory().create_tokenizer(tokenizer_type)
+        self._tokenizer_type = tokenizer_type
+        self._interval = interval
+        self._batch_size = batch_size
+        self._queue = Queue()
+        self._thread = Thread(target = self._run, daemon = True)
+        self._thread.start()
 
     @log
-    def search(self, words, return_content = False):
-        matched_document_ids = None
-        for word in split('\s+', words.strip(' 　')):
-            tokens = self._tokenizer.tokenize(word)
-            connection = connect(self._database_file, isolation_level = 'DEFERRED')
-            connection.execute("PRAGMA journal_mode = OFF")
-            connection.execute("PRAGMA synchronous = OFF")
-            documents = {}
-            with connection:
-                cursor = connection.cursor()
-                cursor.execute('SELECT posting_list FROM indices WHERE token IN("{0}")'.format('", "'.join(str(token) for i, token in tokens)))
-                rows = cursor.fetchall()
-                if len(rows) > 0:
-                    for row in rows:
-                        unpickled = loads(row[0])
-                        for document_id, pl_item in unpickled.posting_list.items():
-                            if document_id not in documents:
-                                documents[document_id] = []
-                            for position in pl_item:
-                                documents[document_id].append((position, unpickled.token))
-                else:
-                    return None
-            if matched_document_ids != None:
-                matched_document_ids = self._get_matched_document_ids(documents, tokens, matched_document_ids)
-            else:
-                matched_document_ids = self._get_matched_document_ids(documents, tokens)
-        documents = self._get_documents(matched_document_ids, return_content)
-        connection.commit()
-        return documents
+    def add(self, documents):
+        return self._submit('add_documents', documents)
 
     @log
-    def _get_matched_document_ids(self, documents, tokens, prev_matched_document_ids = None):
-        matched_document_ids = []
-        number_of_tokens = len(tokens)
-        for document_id, positions in documents.items():
-            if prev_matched_document_ids != None and document_id not in prev_matched_document_ids:
-                continue
-            if number_of_tokens != len({token for pos, token in positions}):
-                continue
-            sequence = 1
-            prev_position = -1
-            for position, token in sorted(positions):
-                if position - prev_position != 1:
-                    sequence = 1
-                if sequence == 1 or (sequence <= number_of_tokens and position - prev_position == 1):
-                    if token == tokens[sequence-1][1]:
-                        if number_of_tokens == sequence:
-                            matched_document_ids.append(document_id)
-                            continue
-                        sequence = sequence + 1
-                prev_position = position
-        return matched_document_ids
+    def update(self, documents):
+        return self._submit('update_documents', documents)
 
     @log
-    def _get_documents(self, matched_document_ids, return_content = False):
-        if len(matched_document_ids) == 0:
-            return []
-        connection = connect(self._database_file)
-        with connection:
-            cursor = connection.cursor()
-            if return_content:
-                cursor.execute('SELECT id, title, content FROM documents WHERE id IN({0})'.format(', '.join(str(i) for i in matched_document_ids)))
-                return [[id, title, str(decompress(content), encoding = 'utf-8')] for id, title, content in cursor.fetchall()]
-            else:
-                cursor.execute('SELECT id, title FROM documents WHERE id IN({0})'.format(', '.join(str(i) for i in matched_document_ids)))
-                return [[id, title] for id, title in cursor.fetchall()]
+    def delete(self, document_ids):
+        return self._submit('delete_documents', document_ids)
+
+    def _submit(self, method, items):
+        future = Future()
+        if not all(self._valid(method, item) for item in items):
+            future.set_exception(TypeError('invalid {0} item'.format(method)))
+        else:
+            self._queue.put((method, items, future))
+        return future
+
+    def _valid(self, method, item):
+        if method == 'delete_documents':
+            return isinstance(item, int)
+        fields = (int, str, str) if method == 'update_documents' else (str, str)
+        return isinstance(item, tuple) and len(item) == len(fields) and all(isinstance(value, field) for value, field in zip(item, fields))
+
+    @log
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        if _is_shard_manifest(self._database_file):
+            indexer = ShardedIndexer(self._database_file, self._tokenizer_type)
+        else:
+            indexer = Indexer(self._database_file, False, self._tokenizer_type)
+        closed = False
+        while not closed:
+            item = self._queue.get()
+            if item == None:
+                break
+            batch = [item]
+            number_of_documents = len(item[1])
+            deadline = time() + self._interval
+            while number_of_documents < self._batch_size:
+                try:
+                    item = self._queue.get(timeout = max(deadline - time(), 0))
+                except Empty:
+                    break
+                if item == None:
+                    closed = True
+                    break
+                batch.append(item)
+                number_of_documents = number_of_documents + len(item[1])
+            self._write(indexer, batch)
+        indexer.close_database_connection()
+
+    @log
+    def _write(self, indexer, batch):
+        applied = []
+        for method, items, future in batch:
+            try:
+                with indexer.savepoint():
+                    applied.append((future, getattr(indexer, method)(items)))
+            except Exception as e:
+                future.set_exception(e)
+        try:
+            indexer.flush()
+        except Exception as e:
+            for future, ids in applied:
+                future.set_exception(e)
+            return
+        for future, ids in applied:
+            future.set_result(ids)
+
+def _non_negative(value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('not an integer: {0}'.format(value))
+    value = int(value)
+    if value < 0:
+        raise ValueError('negative value: {0}'.format(value))
+    return value
+
+class FalconHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
 class FalconHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    paths = ('/search', '/count', '/add', '/update', '/delete', '/bulk', '/metrics')
+
     def initialize(self, database_file, tokenizer):
         self._database_file = database_file
         self._tokenizer = tokenizer
+        if _is_shard_manifest(database_file):
+            self._searcher = ShardedSearcher(database_file, False, tokenizer)
+        else:
+            self._searcher = Searcher(database_file, False, tokenizer)
+        self._writer = IndexWriter(database_file, tokenizer) if not _is_frozen_index(database_file) else None
+
+    def finalize(self):
+        if self._writer != None:
+            self._writer.close()
+        self._searcher.close()
 
     def do_GET(self):
+        self._start = perf_counter()
         url = urlparse(self.path)
         query_string = parse_qs(url.query)
         status_code = 200
         content_type = 'text/html'
         response_body = ''
+        try:
+            limit = _non_negative(query_string['limit'][0]) if 'limit' in query_string else _DEFAULT_LIMIT
+            offset = _non_negative(query_string['offset'][0]) if 'offset' in query_string else 0
+            snippet_size = _non_negative(query_string['snippet'][0]) if 'snippet' in query_string else _SNIPPET_SIZE
+            document_ids = [_non_negative(document_id) for document_id in query_string.get('id', [])]
+        except ValueError:
+            self._send_response(400, content_type, 'Please enter non-negative integers for limit, offset, snippet and id.')
+            return
         try:
             if url.path == '/search':
                 if 'w' in query_string:
                     content_type = 'application/json'
-                    searcher = Searcher(self._database_file, False, self._tokenizer)
-                    search_results = searcher.search(query_string['w'][0], True)
+                    search_results = self._searcher.search(query_string['w'][0], True, limit, offset, snippet_size if snippet_size > 0 else None)
                     response_body = json.dumps(search_results if search_results != None else [], ensure_ascii=False)
                 else:
                     status_code = 400
                     response_body = 'Please enter search word(s).'
+            elif url.path == '/count':
+                if 'w' in query_string:
+                    content_type = 'application/json'
+                    response_body = json.dumps({'count': self._searcher.count(query_string['w'][0])})
+                else:
+                    status_code = 400
+                    response_body = 'Please enter search word(s).'
+            elif url.path in ('/add', '/update', '/delete') and self._writer == None:
+                status_code = 405
+                response_body = 'This index is read-only.'
             elif url.path == '/add':
                 if 't' in query_string and 'c' in query_string:
-                    indexer = Indexer(self._database_file, False, self._tokenizer)
-                    indexer.add_index(query_string['t'][0], query_string['c'][0])
-                    indexer.close_database_connection()
+                    self._writer.add([(query_string['t'][0], query_string['c'][0])]).result()
                     response_body = 'Added:' + query_string['t'][0] + ' ' + query_string['c'][0]
                 else:
                     status_code = 400
                     response_body = 'Please enter document title and content.'
+            elif url.path == '/update':
+                if len(document_ids) > 0 and 't' in query_string and 'c' in query_string:
+                    if len(self._writer.update([(document_ids[0], query_string['t'][0], query_string['c'][0])]).result()) > 0:
+                        response_body = 'Updated:' + query_string['id'][0] + ' ' + query_string['t'][0] + ' ' + query_string['c'][0]
+                    else:
+                        status_code = 404
+                        response_body = 'Document not found.'
+                else:
+                    status_code = 400
+                    response_body = 'Please enter document id, title and content.'
+            elif url.path == '/delete':
+                if len(document_ids) > 0:
+                    content_type = 'application/json'
+                    response_body = json.dumps({'ids': self._writer.delete(document_ids).result()})
+                else:
+                    status_code = 400
+                    response_body = 'Please enter document id(s).'
+            elif url.path == '/metrics':
+                content_type = 'text/plain; version=0.0.4'
+                response_body = _metrics.render(self._gauges())
+            else:
+                status_code = 404
+                response_body = "Ooops, this page doesn't exist."
+        except:
+            status_code = 500
+            content_type = 'text/html'
+            response_body = 'Server error occured.'
+        self._send_response(status_code, content_type, response_body)
+
+    def do_POST(self):
+        self._start = perf_counter()
+        url = urlparse(self.path)
+        status_code = 200
+        content_type = 'text/html'
+        response_body = ''
+        try:
+            request_body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            if url.path == '/search':
+                queries, limit, offset, snippet_size = self._search_request(request_body)
+            elif url.path == '/bulk' and self._writer != None:
+                documents = self._bulk_request(request_body)
+        except (ValueError, KeyError, TypeError):
+            if url.path == '/search':
+                self._send_response(400, content_type, 'Please post search words as a JSON object with a list of queries.')
+            else:
+                self._send_response(400, content_type, 'Please post documents as JSON lines with title and content.')
+            return
+        try:
+            if url.path == '/search':
+                content_type = 'application/json'
+                search_results = self._searcher.search_batch(queries, True, limit, offset, snippet_size if snippet_size > 0 else None)
+                response_body = json.dumps([results if results != None else [] for results in search_results], ensure_ascii=False)
+            elif url.path == '/bulk' and self._writer == None:
+                status_code = 405
+                response_body = 'This index is read-only.'
+            elif url.path == '/bulk':
+                if len(documents) > 0:
+                    content_type = 'application/json'
+                    response_body = json.dumps({'ids': self._writer.add(documents).result()})
+                else:
+                    status_code = 400
+                    response_body = 'Please post documents as JSON lines with title and content.'
             else:
                 status_code = 404
                 response_body = "Ooops, this page doesn't exist."
         except:
             status_code = 500
+            content_type = 'text/html'
             response_body = 'Server error occured.'
+        self._send_response(status_code, content_type, response_body)
+
+    def _search_request(self, request_body):
+        request = json.loads(request_body)
+        queries = request['w']
+        if not isinstance(queries, list) or len(queries) == 0 or not all(isinstance(words, str) for words in queries):
+            raise ValueError('search words must be a non-empty list of strings')
+        return queries, _non_negative(request.get('limit', _DEFAULT_LIMIT)), _non_negative(request.get('offset', 0)), _non_negative(request.get('snippet', _SNIPPET_SIZE))
+
+    def _bulk_request(self, request_body):
+        documents = []
+        for line in request_body.splitlines():
+            if line.strip() != '':
+                document = json.loads(line)
+                if not isinstance(document['title'], str) or not isinstance(document['content'], str):
+                    raise TypeError('title and content must be strings')
+                documents.append((document['title'], document['content']))
+        return documents
+
+    def _gauges(self):
+        statistics = self._searcher.cache_statistics()
+        if isinstance(statistics, dict):
+            statistics = [statistics]
+        gauges = {'falcon_posting_list_cache_' + key: sum(shard[key] for shard in statistics) for key in ('hits', 'misses', 'evictions', 'entries', 'bytes')}
+        statistics = self._searcher.result_cache_statistics()
+        for key in ('hits', 'misses', 'evictions', 'entries', 'bytes'):
+            gauges['falcon_query_result_cache_' + key] = statistics[key]
+        return gauges
+
+    def _send_response(self, status_code, content_type, response_body):
+        encoded = response_body.encode('utf-8')
         self.send_response(status_code)
         self.send_header('Content-type', content_type + ';charset=utf-8')
+        self.send_header('Content-Length', str(len(encoded)))
         self.end_headers()
-        self.wfile.write(response_body.encode('utf-8'))
-        return
+        self.wfile.write(encoded)
+        path = urlparse(self.path).path
+        labels = 'path="{0}"'.format(path if path in self.paths else 'other')
+        _metrics.observe('falcon_http_request_seconds', labels, perf_counter() - self._start)
+        _metrics.increment('falcon_http_requests_total', labels + ',status="{0}"'.format(status_code))
+
+def _generate_vocabulary(seed, size = _BENCHMARK_VOCABULARY_SIZE):
+    generator = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        if generator.random() < 0.5:
+            words.add(''.join(chr(generator.randint(0x61, 0x7a)) for i in range(0, generator.randint(2, 10))))
+        else:
+            words.add(''.join(chr(generator.randint(0x4e00, 0x9fa5) if generator.random() < 0.7 else generator.randint(0x30a1, 0x30f6)) for i in range(0, generator.randint(1, 4))))
+    vocabulary = sorted(words)
+    generator.shuffle(vocabulary)
+    return vocabulary, list(itertools.accumulate(1 / rank ** _BENCHMARK_ZIPF_EXPONENT for rank in range(1, size + 1)))
+
+def _generate_corpus(count, seed = _BENCHMARK_SEED):
+    generator = random.Random(seed)
+    vocabulary, weights = _generate_vocabulary(seed)
+    for i in range(0, count):
+        words = generator.choices(vocabulary, cum_weights = weights, k = generator.randint(20, 200))
+        yield 'doc{0}'.format(i), ''.join(word + ' ' if word.isascii() else word for word in words).strip() + '\n'
+
+def _generate_queries(count, seed = _BENCHMARK_SEED):
+    generator = random.Random(seed + 1)
+    vocabulary, weights = _generate_vocabulary(seed)
+    return {number_of_words: [' '.join(generator.choices(vocabulary, cum_weights = weights, k = number_of_words)) for i in range(0, count)] for number_of_words in range(1, 5)}
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return _max_rss()
+
+class BenchmarkIndexer(Indexer):
+    peak_rss = 0
+
+    @log
+    def _flush_buffer(self, final = False):
+        self._sample_rss()
+        Indexer._flush_buffer(self, final)
+        self._sample_rss()
+
+    @log
+    def _write_segment(self, rows):
+        Indexer._write_segment(self, self._sampled_rows(rows))
+
+    def _sampled_rows(self, rows):
+        for i, row in enumerate(rows):
+            if i % _SQL_CHUNK_SIZE == 0:
+                self._sample_rss()
+            yield row
+
+    def _sample_rss(self):
+        self.peak_rss = max(self.peak_rss, _current_rss())
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+def _benchmark_tokenizer(tokenizer_type, number_of_documents, number_of_queries, seed, directory):
+    database_file = os.path.join(directory, tokenizer_type + '.db')
+    documents = list(_generate_corpus(number_of_documents, seed))
+    corpus_bytes = sum(len(title.encode('utf-8')) + len(content.encode('utf-8')) for title, content in documents)
+    initial_rss = _current_rss()
+    start = perf_counter()
+    indexer = BenchmarkIndexer(database_file, False, tokenizer_type)
+    for i in range(0, len(documents), _BULK_CHUNK_SIZE):
+        indexer.add_documents(documents[i:i+_BULK_CHUNK_SIZE])
+        indexer.commit()
+    indexer.close_database_connection()
+    seconds = perf_counter() - start
+    result = {
+        'ingest': {'seconds': seconds, 'documents_per_second': len(documents) / seconds, 'megabytes_per_second': corpus_bytes / 1048576 / seconds},
+        'database_bytes': os.path.getsize(database_file),
+        'initial_rss_bytes': initial_rss,
+        'flush_peak_rss_bytes': indexer.peak_rss,
+        'queries': {}
+    }
+    searcher = Searcher(database_file, False, tokenizer_type, result_cache_size = 0)
+    for number_of_words, queries in _generate_queries(number_of_queries, seed).items():
+        latencies = []
+        for query in queries:
+            start = perf_counter()
+            searcher.search(query, False, _DEFAULT_LIMIT)
+            latencies.append((perf_counter() - start) * 1000)
+        result['queries'][str(number_of_words)] = {'p50_ms': _percentile(latencies, 50), 'p90_ms': _percentile(latencies, 90), 'p99_ms': _percentile(latencies, 99), 'max_ms': max(latencies)}
+    searcher.close()
+    return result
+
+class Benchmark(object):
+    @log
+    def __init__(self, number_of_documents = _BENCHMARK_DOCUMENTS, number_of_queries = _BENCHMARK_QUERIES, seed = _BENCHMARK_SEED, tokenizer_types = ('Bigram', 'Trigram')):
+        self._number_of_documents = number_of_documents
+        self._number_of_queries = number_of_queries
+        self._seed = seed
+        self._tokenizer_types = tokenizer_types
+
+    @log
+    def run(self):
+        results = {'version': _BENCHMARK_VERSION, 'documents': self._number_of_documents, 'queries': self._number_of_queries, 'seed': self._seed, 'python': sys.version.split()[0], 'tokenizers': {}}
+        with TemporaryDirectory() as directory:
+            for tokenizer_type in self._tokenizer_types:
+                with Pool(1) as pool:
+                    results['tokenizers'][tokenizer_type] = pool.apply(_benchmark_tokenizer, (tokenizer_type, self._number_of_documents, self._number_of_queries, self._seed, directory))
+        return results
+
+    @log
+    def compare(self, results, baseline, tolerance = _BENCHMARK_TOLERANCE):
+        for key in ('version', 'documents', 'queries', 'seed'):
+            if baseline.get(key) != results[key]:
+                raise ValueError('Baseline was run with a different {0}: {1} != {2}'.format(key, baseline.get(key), results[key]))
+        comparison = {}
+        regressions = []
+        current = self._flatten(results['tokenizers'])
+        for name, value in self._flatten(baseline.get('tokenizers', {})).items():
+            if name not in current or value == 0 or name.endswith('.seconds') or name.endswith('initial_rss_bytes'):
+                continue
+            change = (current[name] - value) / value
+            comparison[name] = {'baseline': value, 'current': current[name], 'change': change}
+            if (-change if name.endswith('_per_second') else change) > tolerance:
+                regressions.append(name)
+        return {'comparison': comparison, 'regressions': sorted(regressions)}
+
+    def _flatten(self, results, prefix = ''):
+        flattened = {}
+        for key, value in results.items():
+            if isinstance(value, dict):
+                flattened.update(self._flatten(value, prefix + key + '.'))
+            else:
+                flattened[prefix + key] = value
+        return flattened
 
 class TokenizerFactoryTest(unittest.TestCase):
     def runTest(self):
@@ -303,12 +2836,23 @@ class TokenizerFactoryTest(unittest.TestCase):
 class BigramTokenizerTest(unittest.TestCase):
     def runTest(self):
         self.test_tokenize()
+        self.test_tokenize_ids()
 
     def test_tokenize(self):
         o = BigramTokenizer()
         self.assertEqual(o.tokenize('abcd'), [(0, 'ab'), (1, 'bc'), (2, 'cd')])
         self.assertEqual(o.tokenize('a cd'), [(2, 'cd')])
         self.assertEqual(o.tokenize('president'), [(0, 'pr'), (1, 're'), (2, 'es'), (3, 'si'), (4, 'id'), (5, 'de'), (6, 'en'), (7, 'nt')])
+        self.assertEqual(o.tokenize('検索 エンジン'), [(0, '検索'), (3, 'エン'), (4, 'ンジ'), (5, 'ジン')])
+
+    def test_tokenize_ids(self):
+        o = BigramTokenizer()
+        vocabulary = Vocabulary()
+        counts, positions, token_ids = o.tokenize_ids([('ab', 'c ab'), ('', 'a'), ('b', 'ca')], vocabulary)
+        self.assertEqual(list(counts), [3, 0, 2])
+        self.assertEqual(list(positions), [0, 1, 4, 0, 1])
+        self.assertEqual([vocabulary.tokens[token_id] for token_id in token_ids], ['ab', 'bc', 'ab', 'bc', 'ca'])
+        self.assertEqual(list(token_ids), [0, 1, 0, 1, 2])
 
 class TrigramTokenizerTest(unittest.TestCase):
     def runTest(self):
@@ -322,39 +2866,695 @@ class TrigramTokenizerTest(unittest.TestCase):
 class SearcherTest(unittest.TestCase):
     def runTest(self):
         self.test__get_matched_document_ids()
+        self.test__intersect_document_ids()
+        self.test_search()
+
+    def _posting_lists(self, documents):
+        codec = PostingListCodec()
+        posting_lists = {}
+        for document_id, positions in documents.items():
+            for position, token in positions:
+                posting_lists.setdefault(token, {}).setdefault(document_id, []).append(position)
+        return {token: codec.decode(codec.encode(posting_list)) for token, posting_list in posting_lists.items()}
 
     def test__get_matched_document_ids(self):
         o = Searcher("", False, "Bigram")
-        self.assertEqual(o._get_matched_document_ids({1 : [(0, 'bc'), (1, 'cd')], 2 : [(0, 'bc')]}, [(0, 'bc'), (1, 'cd')]), [1])
-        self.assertEqual(o._get_matched_document_ids({1 : [(0, 'bc')], 2 : [(0, 'bc'), (1, 'cd')]}, [(0, 'bc'), (1, 'cd')]), [2])
-        self.assertEqual(o._get_matched_document_ids({1 : [(0, 'bc'), (1, 'cd')], 2 : [(0, 'bc'), (1, 'cd')]}, [(0, 'bc'), (1, 'cd')]), [1, 2])
-        self.assertEqual(o._get_matched_document_ids({1 : [(0, 'bc'), (1, 'cd'), (2, 'bc')], 2 : [(0, 'bc'), (1, 'cd'), (2, 'cd')]}, [(0, 'bc'), (1, 'cd')]), [1, 2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc'), (1, 'cd')], 2 : [(0, 'bc')]}), [(0, 'bc'), (1, 'cd')]), [1])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc')], 2 : [(0, 'bc'), (1, 'cd')]}), [(0, 'bc'), (1, 'cd')]), [2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc'), (1, 'cd')], 2 : [(0, 'bc'), (1, 'cd')]}), [(0, 'bc'), (1, 'cd')]), [1, 2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc'), (1, 'cd'), (2, 'bc')], 2 : [(0, 'bc'), (1, 'cd'), (2, 'cd')]}), [(0, 'bc'), (1, 'cd')]), [1, 2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc'), (2, 'cd')], 2 : [(3, 'bc'), (4, 'cd')]}), [(0, 'bc'), (1, 'cd')]), [2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'ab'), (1, 'ba'), (2, 'ab')], 2 : [(0, 'ab'), (1, 'ba')]}), [(0, 'ab'), (1, 'ba'), (2, 'ab')]), [1])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc'), (1, 'cd')], 2 : [(0, 'bc'), (1, 'cd')]}), [(0, 'bc'), (1, 'cd')], [2, 3]), [2])
+        self.assertEqual(o._get_matched_document_ids(self._posting_lists({1 : [(0, 'bc')]}), [(0, 'bc'), (1, 'cd')]), [])
+
+    def test_search(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            indexer = Indexer(database_file, False, 'Bigram')
+            indexer.add_index('title1', 'full text search engine')
+            indexer.add_index('title2', "it's a search")
+            indexer.close_database_connection()
+            o = Searcher(database_file, False, 'Bigram')
+            self.assertEqual(o.search('search'), [[2, 'title2'], [1, 'title1']])
+            self.assertEqual(o.search('search', False, 1, 1), [[1, 'title1']])
+            self.assertEqual(o.search('text search', True), [[1, 'title1', 'full text search engine']])
+            self.assertEqual(o.search('"engine"'), [[1, 'title1']])
+            self.assertEqual(o.search('texts'), [])
+            self.assertEqual(o.search('zz'), None)
+            self.assertEqual(o.search('search'), [[2, 'title2'], [1, 'title1']])
+            self.assertEqual(o.search('engine OR it'), [[2, 'title2'], [1, 'title1']])
+            self.assertEqual(o.search('search -text'), [[2, 'title2']])
+            self.assertEqual(o.search('search -te'), [[2, 'title2']])
+            self.assertEqual(o.search('-search'), None)
+            self.assertEqual(o.search('engine', True, None, 0, 6), [[1, 'title1', 'ch eng']])
+            self.assertEqual((o.count('search'), o.count('sear'), o.count('search -text'), o.count('texts'), o.count('zz')), (2, 2, 1, 0, 0))
+            self.assertTrue(o.cache_statistics()['hits'] > 0)
+            self.assertEqual(o.search_batch(['search', 'text  search', 'zz', 'search ', 'engine OR it']), [[[2, 'title2'], [1, 'title1']], [[1, 'title1']], None, [[2, 'title2'], [1, 'title1']], [[2, 'title2'], [1, 'title1']]])
+            self.assertEqual(o.search_batch(['search', 'ext', 'xt'], True, 1, 0, 4), [[[2, 'title2', 'a se']], [[1, 'title1', ' tex']], [[1, 'title1', 'text']]])
+            statistics = o.result_cache_statistics()
+            self.assertEqual((statistics['hits'], statistics['entries']), (4, 15))
+            results = o.search('search')
+            results[0][1] = 'changed'
+            self.assertEqual(o.search('search'), [[2, 'title2'], [1, 'title1']])
+            indexer = Indexer(database_file, False, 'Bigram')
+            indexer.add_documents([('title3', 'search again'), ('title4', 'more text')])
+            indexer.close_database_connection()
+            self.assertEqual(o.search('search'), [[2, 'title2'], [3, 'title3'], [1, 'title1']])
+            self.assertEqual(o.result_cache_statistics()['entries'], 1)
+            self.assertEqual(o.search('again', True, None, 0, 4), [[3, 'title3', 'h ag']])
+            self.assertEqual(o.search('text', True), [[4, 'title4', 'more text'], [1, 'title1', 'full text search engine']])
+            o.close()
+
+    def test__intersect_document_ids(self):
+        self.assertEqual(list(_intersect_document_ids(array('q', [3, 50, 51]), array('q', range(0, 100)))), [3, 50, 51])
+        self.assertEqual(list(_intersect_document_ids(array('q', range(0, 100, 3)), array('q', [0, 2, 30, 31, 99, 100]))), [0, 30, 99])
+        self.assertEqual(list(_intersect_document_ids(array('q', [5]), array('q', [1, 2]))), [])
+
+class DocumentBitmapTest(unittest.TestCase):
+    def runTest(self):
+        self.test_operators()
+        self.test_encode_decode()
+
+    def test_operators(self):
+        sparse = DocumentBitmap([1, 5, 70000])
+        dense = DocumentBitmap(range(0, 10000))
+        self.assertTrue(isinstance(dense.containers[0], int))
+        self.assertEqual(list((sparse & dense).to_array()), [1, 5])
+        self.assertEqual(len(sparse | dense), 10001)
+        self.assertEqual(list((sparse - dense).to_array()), [70000])
+        self.assertEqual(len(dense - DocumentBitmap(range(0, 9000))), 1000)
+        self.assertTrue(isinstance((dense - DocumentBitmap(range(0, 9000))).containers[0], array))
+        self.assertTrue(70000 in sparse and 2 not in sparse and 9999 in dense)
+
+    def test_encode_decode(self):
+        o = DocumentBitmapCodec()
+        bitmap = DocumentBitmap(list(range(0, 5000)) + [65536, 200000])
+        self.assertEqual(list(o.decode(o.encode(bitmap)).to_array()), list(bitmap.to_array()))
+        self.assertEqual(list(o.decode(PostingListCodec().encode({3: [0], 70000: [1]})).to_array()), [3, 70000])
+        self.assertEqual(len(o.union([DocumentBitmap([1]), DocumentBitmap([2]), DocumentBitmap([1, 3])])), 3)
+
+class DocumentStoreTest(unittest.TestCase):
+    def runTest(self):
+        self.test_read()
+        self.test_pack()
+
+    def test_read(self):
+        content = 'full text search ' * 1000
+        for compression in ('Zlib', 'Lzma:1', 'Bz2'):
+            o = DocumentStore(compression)
+            self.assertEqual(o.read(o.encode(content)), content)
+            self.assertTrue(10 <= len(o.read(o.encode(content), 10)) < len(content))
+        self.assertEqual(DocumentStore().read(bz2.compress('legacy'.encode('utf-8'))), 'legacy')
+
+    def test_pack(self):
+        o = DocumentStore()
+        large = 'a' * _DOCUMENT_BLOCK_SIZE
+        rows, blocks = o.pack(['ab', large, 'cd', 'é' * (_DOCUMENT_BLOCK_SIZE // 2 - 1), 'ef'])
+        self.assertEqual([(block, block_index) for content, block, block_index in rows], [(0, 0), (None, None), (0, 1), (0, 2), (None, None)])
+        self.assertEqual((o.read(rows[1][0]), o.read(rows[4][0])), (large, 'ef'))
+        self.assertEqual(o.unpack_block(blocks[0]), ['ab', 'cd', 'é' * (_DOCUMENT_BLOCK_SIZE // 2 - 1)])
+        rows, blocks = o.pack(['small', large, large])
+        self.assertEqual(([(block, block_index) for content, block, block_index in rows], blocks), ([(None, None)] * 3, []))
+        self.assertEqual([o.read(content) for content, block, block_index in rows], ['small', large, large])
+        indexer = Indexer(':memory:', False, 'Bigram')
+        self.assertEqual(indexer.add_documents([('t1', 'small doc'), ('t2', large)]), [1, 2])
+        indexer.close_database_connection()
+        self.assertEqual(_snippet('title', 'abcdefghij', 11, 4), 'efgh')
+
+class PostingListCodecTest(unittest.TestCase):
+    def runTest(self):
+        self.test_encode_decode()
+        self.test_decode_pickle()
+        self.test_migrate()
+
+    def test_encode_decode(self):
+        o = PostingListCodec()
+        posting_list = o.decode(o.encode({300: [5, 1, 200], 2: [0], 70000: [7, 8]}))
+        self.assertEqual(list(posting_list.document_ids), [2, 300, 70000])
+        self.assertEqual(posting_list.positions_count, 6)
+        self.assertEqual(list(posting_list.positions(posting_list.find(70000))), [7, 8])
+        self.assertEqual(posting_list.find(3), -1)
+        self.assertEqual(posting_list.to_dict(), {2: [0], 300: [1, 5, 200], 70000: [7, 8]})
+
+    def test_decode_pickle(self):
+        o = PostingListCodec()
+        inverted_index_hash = InvertedIndexHash('ab', 1, 0)
+        inverted_index_hash.add(1, 3)
+        inverted_index_hash.add(4, 2)
+        self.assertFalse(o.is_encoded(dumps(inverted_index_hash)))
+        self.assertEqual(o.decode(dumps(inverted_index_hash)).to_dict(), {1: [0, 3], 4: [2]})
+
+    def test_migrate(self):
+        o = Indexer(':memory:', False, 'Bigram')
+        o._connection.execute('DROP TABLE indices')
+        o._connection.execute('CREATE TABLE indices (token TEXT PRIMARY KEY, posting_list BLOB)')
+        o._connection.execute('INSERT INTO indices (token, posting_list) VALUES (?, ?)', ('ab', dumps(InvertedIndexHash('ab', 1, 0))))
+        o._connection.execute('INSERT INTO indices (token, posting_list) VALUES (?, ?)', ('bc', o._codec.encode({1: [1]})))
+        o._connection.execute('PRAGMA user_version = 0')
+        self.assertEqual(o.migrate(), 1)
+        self.assertEqual(o.migrate(), 0)
+        rows = o._connection.execute('SELECT token, segment, posting_list FROM indices ORDER BY token').fetchall()
+        self.assertEqual([(token, segment, o._codec.decode(blob).to_dict()) for token, segment, blob in rows], [('ab', 1, {1: [0]}), ('bc', 1, {1: [1]})])
+        self.assertEqual([list(o._bitmap_codec.decode(blob).to_array()) for blob, in o._connection.execute('SELECT bitmap FROM indices ORDER BY token')], [[1], [1]])
+
+class IndexerTest(unittest.TestCase):
+    def runTest(self):
+        self.test__tokenize_documents()
+        self.test__add_batch()
+        self.test__spill()
+        self.test_flush_memory_to_file()
+        self.test_update_delete()
+
+    def test__tokenize_documents(self):
+        documents, blocks, partial_index = _tokenize_documents('Bigram', [('ab', 'abc\n'), ('cd', 'ab')])
+        self.assertEqual([(title, content, length, block, block_index) for title, content, length, block, block_index in documents], [('ab', None, 4, 0, 0), ('cd', None, 3, 0, 1)])
+        self.assertEqual(DocumentStore().unpack_block(blocks[0]), ['abc\n', 'ab'])
+        self.assertEqual(partial_index, {'ab': {0: [0, 2], 1: [2]}, 'ba': {0: [1]}, 'bc': {0: [3]}, 'cd': {1: [0]}, 'da': {1: [1]}})
+
+    def test__add_batch(self):
+        documents = [('ab', 'abc\n'), ('cd', 'ab'), ('bc', 'cdab')]
+        o1 = Indexer(':memory:', False, 'Bigram')
+        for title, content in documents:
+            o1.add_index(title, content)
+        o1._flush_buffer(True)
+        o2 = Indexer(':memory:', False, 'Bigram')
+        self.assertEqual(o2._add_batch(*_tokenize_documents('Bigram', documents[0:2])), [1, 2])
+        self.assertEqual(o2.add_documents(documents[2:3]), [3])
+        o2.flush()
+        query = 'SELECT token, posting_list FROM indices ORDER BY token'
+        self.assertEqual(o1._connection.execute(query).fetchall(), o2._connection.execute(query).fetchall())
+        self.assertEqual(o2._connection.execute('SELECT id, title, length FROM documents').fetchall(), [(1, 'ab', 4), (2, 'cd', 3), (3, 'bc', 5)])
+        self.assertEqual(o2._connection.execute("SELECT key, value FROM metadata WHERE key IN ('document_count', 'total_length') ORDER BY key").fetchall(), [('document_count', 3), ('total_length', 12)])
+
+    def test__spill(self):
+        documents = [('ab', 'abc\n'), ('cd', 'ab'), ('bc', 'cdab')]
+        o1 = Indexer(':memory:', False, 'Bigram')
+        o1.add_documents(documents)
+        o1.flush()
+        o2 = Indexer(':memory:', False, 'Bigram', 0)
+        for title, content in documents:
+            o2.add_index(title, content)
+        self.assertEqual((len(o2._runs), o2._inverted_index), (3, {}))
+        o2.flush()
+        query = 'SELECT token, segment, posting_list, bitmap FROM indices ORDER BY token'
+        self.assertEqual(o1._connection.execute(query).fetchall(), o2._connection.execute(query).fetchall())
+        self.assertEqual(o2._runs, [])
+        directory = o2._spill_directory.name
+        o2.close_database_connection()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_flush_memory_to_file(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            o = Indexer(database_file, True, 'Bigram')
+            o.add_index('ab', 'abc')
+            o.close_database_connection()
+            s = Searcher(database_file, False, 'Bigram')
+            self.assertEqual(s.search('ab'), [[1, 'ab']])
+            o = Indexer(database_file, True, 'Bigram', checkpoint_interval = 0)
+            o.add_index('cd', 'cde')
+            connection = connect(database_file)
+            self.assertEqual(connection.execute('SELECT id, title FROM documents').fetchall(), [(1, 'ab'), (2, 'cd')])
+            self.assertEqual(connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'indices' ORDER BY name").fetchall(), [('indices_segment',), ('sqlite_autoindex_indices_1',)])
+            self.assertTrue('USING INDEX sqlite_autoindex_indices_1' in connection.execute("EXPLAIN QUERY PLAN SELECT posting_list FROM indices WHERE token = 'ab'").fetchall()[0][3])
+            connection.close()
+            o.close_database_connection()
+            self.assertEqual(os.listdir(directory), ['test.db'])
+            self.assertEqual(Searcher(database_file, False, 'Bigram').search('cd'), [[2, 'cd']])
+            self.assertEqual(s.search('cd'), [[2, 'cd']])
+            s.close()
+            o = Indexer(os.path.join(directory, 'failed.db'), True, 'Bigram')
+            o.add_index('ef', 'efg')
+            os.mkdir(os.path.join(directory, 'failed.db'))
+            self.assertRaises(OSError, o.flush_memory_to_file)
+            o._connection.close()
+            self.assertEqual(sorted(os.listdir(directory)), ['failed.db', 'test.db'])
+
+    def test_update_delete(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            o = Indexer(database_file, False, 'Bigram')
+            o.add_documents([('t1', 'full text search'), ('t2', 'search engine'), ('t3', 'engine')])
+            o.flush()
+            s = Searcher(database_file, False, 'Bigram')
+            self.assertEqual((s.count('search'), s.count('engine')), (2, 2))
+            self.assertEqual(o.update_documents([(1, 't1', 'python engine'), (9, 't9', 'missing')]), [1])
+            self.assertEqual(o.delete_documents([2, 8]), [2])
+            o.flush()
+            self.assertEqual((s.count('search'), s.count('engine'), s.count('python')), (0, 2, 1))
+            self.assertEqual(s.search('engine', True, None, 0, 6), [[3, 't3', 'engine'], [1, 't1', 'on eng']])
+            self.assertEqual(o._connection.execute("SELECT value FROM metadata WHERE key = 'document_count'").fetchone()[0], 2)
+            self.assertTrue(o.purge() > 0)
+            self.assertEqual(o._connection.execute("SELECT count(*) FROM indices WHERE token = 'se'").fetchone()[0], 0)
+            self.assertEqual(o._connection.execute('SELECT count(*) FROM tombstones').fetchone()[0], 0)
+            self.assertEqual((s.count('search'), s.count('engine'), s.count('python')), (0, 2, 1))
+            self.assertEqual(o.purge(), 0)
+            o.close_database_connection()
+            s.close()
+            o = Indexer(database_file, True, 'Bigram')
+            document_ids = o.add_documents([('t', 'memory {0}'.format(i)) for i in range(0, _PURGE_THRESHOLD)])
+            o.delete_documents(document_ids)
+            o.flush()
+            self.assertEqual((o._connection.execute('SELECT count(*) FROM tombstones').fetchone()[0], o._connection.execute("SELECT count(*) FROM indices WHERE token = 'me'").fetchone()[0]), (0, 0))
+            o.close_database_connection()
+            self.test_delete_during_merge()
+
+    def test_delete_during_merge(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            o = Indexer(database_file, False, 'Bigram')
+            o._merger.request = lambda: None
+            for i in range(0, _MERGE_FACTOR):
+                o.add_index('t' + str(i), 'ghost' if i == _MERGE_FACTOR - 1 else str(i))
+                o.flush()
+            merger = SegmentMerger(database_file)
+            thread = Thread(target = lambda: merger.merge(connect(database_file, isolation_level = 'DEFERRED', timeout = _BUSY_TIMEOUT)))
+            tokenize = o._tokenizer.tokenize
+            def interleave(title, content):
+                if not thread.is_alive():
+                    thread.start()
+                    thread.join(0.2)
+                return tokenize(title, content)
+            o._tokenizer.tokenize = interleave
+            self.assertEqual(o.delete_documents([_MERGE_FACTOR]), [_MERGE_FACTOR])
+            o._tokenizer.tokenize = tokenize
+            o.commit()
+            thread.join()
+            self.assertEqual(o._connection.execute('SELECT count(*) FROM segments').fetchone()[0], 1)
+            s = Searcher(database_file, False, 'Bigram')
+            self.assertEqual(s.count('ghost'), 0)
+            o.purge()
+            self.assertEqual(o.add_index('t', 'unrelated'), _MERGE_FACTOR + 1)
+            o.flush()
+            self.assertEqual((s.count('ghost'), s.search('unrelated')), (0, [[_MERGE_FACTOR + 1, 't']]))
+            o.close_database_connection()
+            s.close()
+
+class SegmentMergerTest(unittest.TestCase):
+    def runTest(self):
+        self.test_merge()
+
+    def test_merge(self):
+        o = Indexer(':memory:', True, 'Bigram')
+        for i in range(0, _MERGE_FACTOR + 1):
+            o.add_index('ab', str(i))
+            o._flush_buffer(True)
+        o._connection.commit()
+        self.assertEqual(o._connection.execute('SELECT count(*) FROM segments').fetchone()[0], _MERGE_FACTOR + 1)
+        self.assertEqual(o._merger.merge(), 1)
+        self.assertEqual(o._connection.execute('SELECT id, level, merged_into FROM segments ORDER BY id').fetchall(), [(_MERGE_FACTOR + 1, 0, None), (_MERGE_FACTOR + 2, 0, None)])
+        rows = o._connection.execute("SELECT segment, posting_list FROM indices WHERE token = 'ab' ORDER BY segment").fetchall()
+        self.assertEqual([(segment, o._codec.decode(blob).to_dict()) for segment, blob in rows], [(_MERGE_FACTOR + 1, {_MERGE_FACTOR + 1: [0]}), (_MERGE_FACTOR + 2, {i: [0] for i in range(1, _MERGE_FACTOR + 1)})])
+        self.assertEqual(o._merger.merge(), 0)
+        self.test_merge_tombstones()
+
+    def test_merge_tombstones(self):
+        o = Indexer(':memory:', True, 'Bigram')
+        for i in range(0, _MERGE_FACTOR):
+            o.add_index('ab', str(i))
+            o._flush_buffer(True)
+        o.delete_documents([2, 3])
+        o._connection.commit()
+        self.assertEqual(o._merger.merge(), 1)
+        rows = o._connection.execute("SELECT posting_list FROM indices WHERE token = 'ab'").fetchall()
+        self.assertEqual([list(o._codec.decode(blob).document_ids) for blob, in rows], [[1] + list(range(4, _MERGE_FACTOR + 1))])
+
+class PostingListCacheTest(unittest.TestCase):
+    def runTest(self):
+        self.test_get_put()
+
+    def test_get_put(self):
+        codec = PostingListCodec()
+        posting_list = codec.decode(codec.encode({1: [0]}))
+        o = PostingListCache((posting_list.size + _CACHE_ENTRY_OVERHEAD) * 2)
+        o.put('ab', posting_list, 1)
+        o.put('bc', posting_list, 1)
+        self.assertEqual(o.get('ab', 1), posting_list)
+        o.put('cd', posting_list, 1)
+        self.assertEqual(o.get('bc', 1), None)
+        self.assertEqual(o.get('ab', 1), posting_list)
+        self.assertEqual(o.get('ab', 2), None)
+        statistics = o.statistics()
+        self.assertEqual((statistics['hits'], statistics['misses'], statistics['evictions'], statistics['entries']), (2, 2, 1, 0))
+
+class QueryResultCacheTest(unittest.TestCase):
+    def runTest(self):
+        self.test_search()
+
+    def test_search(self):
+        searched = []
+        def search(queries):
+            searched.append(queries)
+            return [[[len(words)]] if words != 'zz' else None for words in queries]
+        o = QueryResultCache(_result_size(('ab cd',), [[5]]) + _result_size(('zz',), None))
+        self.assertEqual(o.search(search, ['ab', ' ab  cd', 'ab', 'zz'], ('Bigram',), 1), [[[2]], [[5]], [[2]], None])
+        self.assertEqual(o.search(search, ['zz', 'ab cd'], ('Bigram',), 1), [None, [[5]]])
+        self.assertEqual(o.search(search, ['ab'], ('Trigram',), 1), [[[2]]])
+        self.assertEqual(o.search(search, ['zz'], ('Bigram',), 2), [None])
+        self.assertEqual(o.search(search, ['ab'], ('Bigram',), None), [[[2]]])
+        self.assertEqual(o.search(search, ['ab'], ('Bigram',), None), [[[2]]])
+        self.assertEqual(searched, [['ab', 'ab cd', 'zz'], ['ab'], ['zz'], ['ab'], ['ab']])
+        statistics = o.statistics()
+        self.assertEqual((statistics['hits'], statistics['misses'], statistics['evictions'], statistics['entries']), (2, 7, 3, 0))
+        o = QueryResultCache(_result_size(('ab',), None))
+        self.assertEqual(o.search(search, ['ab', 'ab'], ('Bigram',), 1), [[[2]], [[2]]])
+        self.assertEqual(o.statistics()['entries'], 0)
+
+class MetricsTest(unittest.TestCase):
+    def runTest(self):
+        self.test_render()
+        self.test_profiler()
+
+    def test_render(self):
+        self.assertFalse(hasattr(Searcher.__dict__['search'], '__wrapped__'))
+        o = Metrics((0.001, 0.01))
+        o.observe('falcon_stage_seconds', 'stage="match"', 0.0005)
+        o.observe('falcon_stage_seconds', 'stage="match"', 0.005)
+        o.observe('falcon_stage_seconds', 'stage="match"', 1)
+        o.increment('falcon_documents_indexed_total', '', 3)
+        self.assertEqual(o.histogram('falcon_stage_seconds', 'stage="match"'), {'count': 3, 'sum': 1.0055})
+        self.assertEqual(o.render({'falcon_posting_list_cache_hits': 2}).splitlines(), [
+            '# TYPE falcon_stage_seconds histogram',
+            'falcon_stage_seconds_bucket{stage="match",le="0.001"} 1',
+            'falcon_stage_seconds_bucket{stage="match",le="0.01"} 2',
+            'falcon_stage_seconds_bucket{stage="match",le="+Inf"} 3',
+            'falcon_stage_seconds_sum{stage="match"} 1.0055',
+            'falcon_stage_seconds_count{stage="match"} 3',
+            '# TYPE falcon_documents_indexed_total counter',
+            'falcon_documents_indexed_total 3',
+            '# TYPE falcon_posting_list_cache_hits gauge',
+            'falcon_posting_list_cache_hits 2'])
+
+    def test_profiler(self):
+        o = SamplingProfiler(0.001)
+        o.start()
+        start = perf_counter()
+        while perf_counter() - start < 0.1:
+            pass
+        o.stop()
+        self.assertTrue(any('MetricsTest.test_profiler' in stack for stack in o.samples()))
+
+class FrozenIndexTest(unittest.TestCase):
+    def runTest(self):
+        self.test_build()
+
+    def test_build(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            frozen_file = os.path.join(directory, 'test.idx')
+            indexer = Indexer(database_file, False, 'Trigram')
+            indexer.add_index('title1', 'full text search engine')
+            indexer.flush()
+            indexer.add_index('title2', "it's a search")
+            indexer.add_index('title3', 'search again')
+            indexer.close_database_connection()
+            self.assertRaises(ValueError, FrozenIndexBuilder(database_file, 'Bigram').build, frozen_file)
+            manifest_file = os.path.join(directory, 'test.json')
+            ShardedIndexer(manifest_file, 'Trigram', 2).close_database_connection()
+            self.assertRaises(ValueError, FrozenIndexBuilder(manifest_file, 'Trigram').build, frozen_file)
+            self.assertEqual(FrozenIndexBuilder(database_file, 'Trigram').build(frozen_file), 27)
+            self.assertTrue(_is_frozen_index(frozen_file))
+            self.assertFalse(_is_shard_manifest(frozen_file))
+            o = FrozenIndex(frozen_file)
+            self.assertEqual(o.tokenizer_type, 'Trigram')
+            self.assertEqual(o.metadata, {'generation': 0, 'document_count': 3, 'total_length': 41})
+            self.assertEqual(PostingListCodec().decode(o.posting_list('sea')).to_dict(), {1: [16], 2: [13], 3: [6]})
+            self.assertEqual(o.posting_list('zzz'), None)
+            title, content, length = o.document(2)
+            self.assertEqual((title, DocumentStore().read(content), length), ('title2', "it's a search", 10))
+            self.assertEqual(o.document(4), None)
+            o.close()
+            s = Searcher(database_file, False, 'Trigram')
+            o = Searcher(frozen_file, False, 'Bigram')
+            for query in ('search', 'text search', 'engine', 'zzz'):
+                self.assertEqual(o.search(query, True), s.search(query, True))
+            self.assertEqual(o.search('search', False, 1, 1), [[3, 'title3']])
+            o.close()
+            s.close()
+
+class BenchmarkTest(unittest.TestCase):
+    def runTest(self):
+        self.test__generate_corpus()
+        self.test_run_compare()
+
+    def test__generate_corpus(self):
+        documents = list(_generate_corpus(50))
+        self.assertEqual(documents, list(_generate_corpus(50)))
+        self.assertNotEqual(documents, list(_generate_corpus(50, 2)))
+        content = ''.join(content for title, content in documents)
+        self.assertTrue(any(character.isascii() and character.isalpha() for character in content))
+        self.assertTrue(any(0x4e00 <= ord(character) <= 0x9fa5 for character in content))
+        self.assertEqual([len(queries) for number_of_words, queries in sorted(_generate_queries(5).items())], [5, 5, 5, 5])
+
+    def test_run_compare(self):
+        o = Benchmark(20, 2, 1, ('Bigram',))
+        results = o.run()
+        result = results['tokenizers']['Bigram']
+        self.assertEqual(sorted(result['queries']), ['1', '2', '3', '4'])
+        self.assertTrue(result['ingest']['documents_per_second'] > 0 and result['database_bytes'] > 0 and result['flush_peak_rss_bytes'] > 0)
+        self.assertEqual(o.compare(results, results)['regressions'], [])
+        baseline = json.loads(json.dumps(results))
+        baseline['tokenizers']['Bigram']['ingest']['documents_per_second'] *= 2
+        baseline['tokenizers']['Bigram']['database_bytes'] *= 2
+        comparison = o.compare(results, baseline)
+        self.assertEqual(comparison['regressions'], ['Bigram.ingest.documents_per_second'])
+        self.assertAlmostEqual(comparison['comparison']['Bigram.database_bytes']['change'], -0.5)
+        baseline['documents'] = 10
+        self.assertRaises(ValueError, o.compare, results, baseline)
+
+class ShardedTest(unittest.TestCase):
+    def runTest(self):
+        self.test_search()
+
+    def test_search(self):
+        with TemporaryDirectory() as directory:
+            manifest_file = os.path.join(directory, 'test.json')
+            documents = [('title1', 'hello python'), ('title2', 'hello world hello'), ('title3', 'python world'), ('title4', 'hello world')]
+            o = ShardedIndexer(manifest_file, 'Bigram', 2)
+            self.assertEqual(o.add_documents(documents), [1, 2, 3, 4])
+            o.close_database_connection()
+            self.assertTrue(_is_shard_manifest(manifest_file))
+            self.assertEqual(ShardManifest(manifest_file).shard_of(3), 1)
+            manifests = [ShardManifest(manifest_file) for i in range(0, 2)]
+            self.assertEqual([list(manifest.allocate(2)) for manifest in manifests], [[5, 6], [7, 8]])
+            with ThreadPoolExecutor(4) as executor:
+                allocated = [document_id for document_ids in executor.map(lambda i: manifests[i % 2].allocate(1), range(0, 40)) for document_id in document_ids]
+            self.assertEqual(sorted(allocated), list(range(9, 49)))
+            s = Searcher(os.path.join(directory, 'single.db'), False, 'Bigram')
+            i = Indexer(os.path.join(directory, 'single.db'), False, 'Bigram')
+            i.add_documents(documents)
+            i.close_database_connection()
+            o = ShardedSearcher(manifest_file, False, None)
+            self.assertEqual(o.search('hello'), s.search('hello'))
+            self.assertEqual(o.search('hello', False, 1, 1), [[4, 'title4']])
+            self.assertEqual(o.search('world', True, 1), [[4, 'title4', 'hello world']])
+            self.assertEqual(o.search('java'), None)
+            self.assertEqual(o.search_batch(['hello', 'java', 'hello']), [s.search('hello'), None, s.search('hello')])
+            self.assertEqual(o.result_cache_statistics()['hits'], 2)
+            o.close()
+            s.close()
+            self.test_search_skewed()
+
+    def test_search_skewed(self):
+        with TemporaryDirectory() as directory:
+            documents = [('title' + str(i), ('ab' if i % 2 == 0 else 'bc') + ' x' * (i % 5) + (' qq' if i % 3 == 0 else '') + ((' abc abc qq' if i % 4 < 2 else ' abc qq qq') if i > 40 else '')) for i in range(1, 51)]
+            o = ShardedIndexer(os.path.join(directory, 'test.json'), 'Bigram', 2)
+            o.add_documents(documents)
+            o.close_database_connection()
+            i = Indexer(os.path.join(directory, 'single.db'), False, 'Bigram')
+            i.add_documents(documents)
+            i.close_database_connection()
+            o = ShardedSearcher(os.path.join(directory, 'test.json'), False, None)
+            s = Searcher(os.path.join(directory, 'single.db'), False, 'Bigram')
+            for words in ('abc qq', 'abc OR qq', 'qq abc -x', 'ab bc'):
+                self.assertEqual(o.search(words), s.search(words))
+            o.close()
+            s.close()
+
+class IndexWriterTest(unittest.TestCase):
+    def runTest(self):
+        self.test_write()
+
+    def test_write(self):
+        with TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'test.db')
+            o = IndexWriter(database_file, 'Bigram', 0.2)
+            added = o.add([('title1', 'search engine')])
+            invalid = o.add([('title2', 'search'), ('bad', 5)])
+            deleted = o.delete([1, 9])
+            self.assertEqual((added.result(), deleted.result()), ([1], [1]))
+            self.assertRaises(TypeError, invalid.result)
+            self.assertEqual(o.update([(2, 'title2', 'missing')]).result(), [])
+            self.assertEqual(o.add([('title3', 'engine')]).result(), [2])
+            o.close()
+            s = Searcher(database_file, False, 'Bigram')
+            self.assertEqual((s.search('engine'), s.search('search')), ([[2, 'title3']], []))
+            s.close()
+            i = Indexer(database_file, False, 'Bigram')
+            i.add_documents([('title4', 'search engine')])
+            with self.assertRaises(ZeroDivisionError):
+                with i.savepoint():
+                    i.add_documents([('title5', 'search failure')])
+                    1 / 0
+            i.add_documents([('title6', 'failure')])
+            i.flush()
+            i.close_database_connection()
+            s = Searcher(database_file, False, 'Bigram')
+            self.assertEqual((s.search('search'), s.search('failure')), ([[3, 'title4']], [[4, 'title6']]))
+            s.close()
+            connection = connect(database_file)
+            self.assertEqual(connection.execute("SELECT value FROM metadata WHERE key = 'document_count'").fetchone()[0], 3)
+            connection.close()
+
+class FalconHTTPRequestHandlerTest(unittest.TestCase):
+    def runTest(self):
+        self.test_requests()
+
+    def test_requests(self):
+        from http.client import HTTPConnection
+        from urllib.parse import quote
+        with TemporaryDirectory() as directory:
+            handler = FalconHTTPRequestHandler
+            handler.log_message = lambda self, format, *args: None
+            handler.initialize(handler, os.path.join(directory, 'test.db'), 'Bigram')
+            httpd = FalconHTTPServer(('127.0.0.1', 0), handler)
+            Thread(target = httpd.serve_forever, daemon = True).start()
+            try:
+                connection = HTTPConnection('127.0.0.1', httpd.server_address[1])
+                connection.request('GET', '/add?t=title1&c=' + quote('full text search'))
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (200, b'Added:title1 full text search'))
+                connection.request('POST', '/bulk', json.dumps({'title': 'title2', 'content': 'search engine'}) + '\n' + json.dumps({'title': 'title3', 'content': 'engine'}))
+                response = connection.getresponse()
+                self.assertEqual((response.status, json.loads(response.read().decode('utf-8'))), (200, {'ids': [2, 3]}))
+                connection.request('GET', '/search?w=search')
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), [[2, 'title2', 'search engine'], [1, 'title1', 'full text search']])
+                connection.request('GET', '/count?w=' + quote('search -full'))
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), {'count': 1})
+                connection.request('GET', '/search?w=search&limit=1&offset=1')
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), [[1, 'title1', 'full text search']])
+                connection.request('POST', '/search', json.dumps({'w': ['search', 'zz', 'engine'], 'limit': 1}))
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), [[[2, 'title2', 'search engine']], [], [[3, 'title3', 'engine']]])
+                connection.request('POST', '/search', json.dumps({'w': 'search'}))
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (400, b'Please post search words as a JSON object with a list of queries.'))
+                connection.request('GET', '/update?id=1&t=title1&c=' + quote('full text engine'))
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (200, b'Updated:1 title1 full text engine'))
+                for path in ('/search?w=search&limit=x', '/search?w=search&offset=-1', '/search?w=search&snippet=1.5', '/delete?id=a', '/update?id=-1&t=t&c=c'):
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    self.assertEqual((response.status, response.read()), (400, b'Please enter non-negative integers for limit, offset, snippet and id.'))
+                for request in ({'w': ['search'], 'limit': -1}, {'w': ['search'], 'limit': 1.5}, {'w': ['search'], 'offset': True}, ['search']):
+                    connection.request('POST', '/search', json.dumps(request))
+                    response = connection.getresponse()
+                    self.assertEqual((response.status, response.read()), (400, b'Please post search words as a JSON object with a list of queries.'))
+                def fail(*args):
+                    raise ValueError('engine failure')
+                handler._searcher.search = handler._searcher.search_batch = fail
+                try:
+                    connection.request('GET', '/search?w=search')
+                    response = connection.getresponse()
+                    self.assertEqual((response.status, response.read()), (500, b'Server error occured.'))
+                    connection.request('POST', '/search', json.dumps({'w': ['search']}))
+                    response = connection.getresponse()
+                    self.assertEqual((response.status, response.read()), (500, b'Server error occured.'))
+                finally:
+                    del handler._searcher.search, handler._searcher.search_batch
+                connection.request('GET', '/update?id=9&t=title9&c=missing')
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (404, b'Document not found.'))
+                connection.request('GET', '/delete?id=3&id=9')
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), {'ids': [3]})
+                connection.request('GET', '/count?w=engine')
+                response = connection.getresponse()
+                self.assertEqual(json.loads(response.read().decode('utf-8')), {'count': 2})
+                connection.request('POST', '/bulk', 'not json')
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (400, b'Please post documents as JSON lines with title and content.'))
+                connection.request('POST', '/bulk', json.dumps({'title': 'title4', 'content': 4}))
+                response = connection.getresponse()
+                self.assertEqual((response.status, response.read()), (400, b'Please post documents as JSON lines with title and content.'))
+                connection.request('GET', '/metrics')
+                response = connection.getresponse()
+                metrics = response.read().decode('utf-8')
+                self.assertEqual(response.status, 200)
+                self.assertIn('falcon_http_requests_total{path="/bulk",status="400"} 2', metrics)
+                self.assertIn('falcon_http_request_seconds_count{path="/search"} 13', metrics)
+                self.assertIn('falcon_posting_list_cache_misses', metrics)
+                self.assertIn('falcon_query_result_cache_hits', metrics)
+                connection.close()
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+                handler.finalize(handler)
 
 class IndexManager(object):
     
     debug = False
-    test_classes = (SearcherTest, TokenizerFactoryTest, BigramTokenizerTest, TrigramTokenizerTest)
+    test_classes = (SearcherTest, TokenizerFactoryTest, BigramTokenizerTest, TrigramTokenizerTest, PostingListCodecTest, DocumentBitmapTest, DocumentStoreTest, IndexerTest, SegmentMergerTest, PostingListCacheTest, QueryResultCacheTest, MetricsTest, FrozenIndexTest, BenchmarkTest, ShardedTest, IndexWriterTest, FalconHTTPRequestHandlerTest)
 
     @log
     def run(self):
         parser = ArgumentParser(description='Falcon Full Text Search Engine')
+        parser.add_argument('-B', '--benchmark', metavar='documents', help='run benchmark with this number of synthetic documents and print JSON results', type=int, nargs='?', const=_BENCHMARK_DOCUMENTS)
         parser.add_argument('-C', '--showdocument', help='show document(s)', action='store_true')
         parser.add_argument('-D', '--debug', help='enable debug mode', action='store_true')
+        parser.add_argument('-F', '--freeze', metavar='frozenfile', help='export database to a read-only memory-mapped index file (give the tokenizer the database was indexed with by -z)')
         parser.add_argument('-H', '--httpserver', help='run http server mode', action='store_true')
         parser.add_argument('-I', '--showindex', help='show index', action='store_true')
+        parser.add_argument('-K', '--checkpoint', metavar='seconds', help='in memory database mode, save the database to the file at this interval', type=float)
+        parser.add_argument('-L', '--memorybudget', metavar='megabytes', help='spill the in-memory index to temporary files above this size', type=int, default=_DEFAULT_MEMORY_BUDGET)
         parser.add_argument('-M', '--memorymode', help='enable in memory database mode', action='store_true')
+        parser.add_argument('-P', '--processes', metavar='processes', help='index input file(s) in bulk with this number of worker processes')
+        parser.add_argument('-R', '--profile', metavar='profilefile', help='sample call stacks while running and write them to this file in folded format')
+        parser.add_argument('-S', '--shards', metavar='shards', help='create a sharded index with this number of shard databases', type=int)
         parser.add_argument('-T', '--test', help='run test', action='store_true')
+        parser.add_argument('-U', '--upgrade', help='upgrade database to the current format', action='store_true')
+        parser.add_argument('-X', '--purge', help='remove deleted and updated documents from posting lists', action='store_true')
+        parser.add_argument('-b', '--baseline', metavar='baselinefile', help='compare benchmark results with a previous JSON result file')
         parser.add_argument('-c', '--content', metavar='content', help='document content to be stored and indexed')
         parser.add_argument('-d', '--databasefile', metavar='databasefile', help='a database file')
+        parser.add_argument('-e', '--compression', metavar='compression', help='Type of document compression [Zlib, Lzma, Bz2], optionally with a level such as Zlib:9', default=_DEFAULT_COMPRESSION)
+        parser.add_argument('-l', '--limit', metavar='limit', help='maximum number of search results', type=_non_negative, default=_DEFAULT_LIMIT)
+        parser.add_argument('-m', '--metrics', help='collect per-stage timers and counters', action='store_true')
+        parser.add_argument('-n', '--count', help='print the number of documents matching the query instead of the documents', action='store_true')
+        parser.add_argument('-o', '--offset', metavar='offset', help='number of search results to skip', type=_non_negative, default=0)
         parser.add_argument('-p', '--port', metavar='port', help='http port')
         parser.add_argument('-q', '--query', metavar='query', help='query string')
         parser.add_argument('-t', '--title', metavar='title', help='document title to be stored and indexed')
+        parser.add_argument('-u', '--update', metavar='documentid', help='replace the title and content of this document', type=int)
+        parser.add_argument('-x', '--delete', metavar='documentid', help='delete document(s)', type=int, nargs='+')
         parser.add_argument('-z', '--tokenizer', metavar='tokenizer', help='Type of tokenizer [Bigram, Trigram]')
         parser.add_argument('files', metavar='files', nargs='*', help='input file(s)')
         self._args = parser.parse_args()
 
-        IndexManager.debug = self._args.debug
+        if self._args.debug:
+            _enable_debug()
+        if self._args.metrics:
+            _metrics.enable()
+
+        profiler = SamplingProfiler() if self._args.profile != None else None
+        if profiler != None:
+            profiler.start()
+        try:
+            self._execute()
+        finally:
+            if profiler != None:
+                profiler.stop()
+                with open(self._args.profile, 'w') as f:
+                    profiler.dump(f)
+            if self._args.metrics and not self._args.httpserver:
+                print(_metrics.render(), end = '', file = sys.stderr)
 
+    @log
+    def _execute(self):
         if self._args.test:
             suite = unittest.TestSuite()
             for test_class in IndexManager.test_classes:
@@ -362,6 +3562,16 @@ class IndexManager(object):
             runner = unittest.TextTestRunner()
             runner.run(suite)
 
+        if self._args.benchmark != None:
+            benchmark = Benchmark(self._args.benchmark)
+            results = benchmark.run()
+            if self._args.baseline != None:
+                with open(self._args.baseline) as f:
+                    results.update(benchmark.compare(results, json.load(f)))
+            print(json.dumps(results, indent = 2, sort_keys = True))
+            if len(results.get('regressions', [])) > 0:
+                exit(1)
+
         if self._args.tokenizer == None:
             self._args.tokenizer = _DEFAULT_TOKENIZER
 
@@ -370,49 +3580,115 @@ class IndexManager(object):
                 self._args.port = _DEFAULT_PORT
             handler = FalconHTTPRequestHandler
             handler.initialize(handler, self._args.databasefile, self._args.tokenizer)
-            httpd = HTTPServer(("", int(self._args.port)), handler)
+            httpd = FalconHTTPServer(("", int(self._args.port)), handler)
             print("Falcon is serving at port", self._args.port)
-            httpd.serve_forever()
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                httpd.server_close()
+                handler.finalize(handler)
 
         elif not self._args.httpserver and self._args.databasefile != None:
+            sharded = self._args.shards != None or _is_shard_manifest(self._args.databasefile)
+            if self._args.upgrade:
+                for database_file in self._database_files(sharded):
+                    indexer = Indexer(database_file, False, self._args.tokenizer)
+                    indexer.close_database_connection()
+                print('Database is upgraded to version', _SCHEMA_VERSION)
+
+            if self._args.purge:
+                indexer = ShardedIndexer(self._args.databasefile, self._args.tokenizer) if sharded else Indexer(self._args.databasefile, False, self._args.tokenizer)
+                print('Purged posting lists:', indexer.purge())
+                indexer.close_database_connection()
+
+            if self._args.freeze != None:
+                try:
+                    FrozenIndexBuilder(self._args.databasefile, self._args.tokenizer).build(self._args.freeze)
+                except ValueError as e:
+                    print(e, file = sys.stderr)
+                    exit(1)
+                print('Frozen index is written to', self._args.freeze)
+
             if self._args.query != None:
-                searcher = Searcher(self._args.databasefile, self._args.memorymode, self._args.tokenizer)
-                search_results = searcher.search(self._args.query, True)
-                if search_results != None:
-                    for row in search_results:
-                        print(row[0], row[1], row[2][0:100])
+                if sharded:
+                    searcher = ShardedSearcher(self._args.databasefile, self._args.memorymode, self._args.tokenizer)
+                else:
+                    searcher = Searcher(self._args.databasefile, self._args.memorymode, self._args.tokenizer)
+                if self._args.count:
+                    print(searcher.count(self._args.query))
+                else:
+                    search_results = searcher.search(self._args.query, True, self._args.limit, self._args.offset, _SNIPPET_SIZE)
+                    if search_results != None:
+                        for row in search_results:
+                            print(row[0], row[1], row[2])
+                searcher.close()
+            elif self._args.update != None or self._args.delete != None:
+                if sharded:
+                    indexer = ShardedIndexer(self._args.databasefile, self._args.tokenizer, self._args.shards, self._args.memorybudget, self._args.compression)
+                else:
+                    indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer, self._args.memorybudget, self._args.checkpoint, self._args.compression)
+                if self._args.update != None and self._args.title != None and self._args.content != None:
+                    print('Updated:', *indexer.update_documents([(self._args.update, self._args.title, self._args.content)]))
+                if self._args.delete != None:
+                    print('Deleted:', *indexer.delete_documents(self._args.delete))
+                indexer.close_database_connection()
+            elif self._args.title != None and self._args.content != None and sharded:
+                indexer = ShardedIndexer(self._args.databasefile, self._args.tokenizer, self._args.shards, self._args.memorybudget, self._args.compression)
+                indexer.add_index(self._args.title, self._args.content)
+                indexer.close_database_connection()
+            elif len(self._args.files) > 0 and sharded:
+                indexer = ShardedIndexer(self._args.databasefile, self._args.tokenizer, self._args.shards, self._args.memorybudget, self._args.compression)
+                indexer.add_files(self._args.files, int(self._args.processes) if self._args.processes != None else None)
+                indexer.close_database_connection()
             elif self._args.title != None and self._args.content != None:
-                indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer)
+                indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer, self._args.memorybudget, self._args.checkpoint, self._args.compression)
                 indexer.add_index(self._args.title, self._args.content)
                 indexer.close_database_connection()
-            elif self._args.files != None:
-                indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer)
+            elif len(self._args.files) > 0 and self._args.processes != None:
+                indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer, self._args.memorybudget, self._args.checkpoint, self._args.compression)
+                indexer.add_files(self._args.files, int(self._args.processes))
+                indexer.close_database_connection()
+            elif not sharded:
+                indexer = Indexer(self._args.databasefile, self._args.memorymode, self._args.tokenizer, self._args.memorybudget, self._args.checkpoint, self._args.compression)
                 for file_name in self._args.files:
                     with open(file_name) as f:
                         for line in f:
                             l = split(',', line, 1)
                             indexer.add_index(l[0], l[1])
-                    if self._args.memorymode:
-                        indexer.flush_memory_to_file()
-                    else:
-                        indexer.close_database_connection()
+                indexer.close_database_connection()
 
-            if self._args.showindex:
-                connection = connect(self._args.databasefile)
+            for database_file in self._database_files(sharded) if self._args.showindex else []:
+                connection = connect(database_file)
                 with connection:
                     cursor = connection.cursor()
-                    cursor.execute('SELECT token, posting_list FROM indices ORDER BY token')
-                    for k1, v1 in cursor.fetchall():
-                        o = loads(v1)
-                        print(o.token, o.positions_count, o.posting_list)
+                    cursor.execute('SELECT token, posting_list FROM indices ORDER BY token, segment')
+                    codec = PostingListCodec()
+                    posting_lists = {}
+                    for token, blob in cursor.fetchall():
+                        posting_lists.setdefault(token, []).append(codec.decode(blob))
+                    for token, posting_list in posting_lists.items():
+                        o = codec.union(posting_list)
+                        print(token, o.positions_count, o.to_dict())
 
-            if self._args.showdocument:
-                connection = connect(self._args.databasefile)
+            for database_file in self._database_files(sharded) if self._args.showdocument else []:
+                connection = connect(database_file)
                 with connection:
                     cursor = connection.cursor()
-                    cursor.execute('SELECT id, title, content FROM documents')
-                    for row in cursor.fetchall():
+                    cursor.execute('SELECT id FROM documents ORDER BY id')
+                    document_ids = [document_id for document_id, in cursor.fetchall()]
+                searcher = Searcher(database_file, False, self._args.tokenizer)
+                for i in range(0, len(document_ids), _SQL_CHUNK_SIZE):
+                    for row in searcher._get_documents(document_ids[i:i+_SQL_CHUNK_SIZE], True):
                         print(row[0], row[1], row[2])
+                searcher.close()
+
+    @log
+    def _database_files(self, sharded):
+        if sharded:
+            return ShardManifest(self._args.databasefile, self._args.tokenizer, self._args.shards).shard_files
+        return [self._args.databasefile]
 
 if __name__ == '__main__':
     index_manager = IndexManager()
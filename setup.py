@@ -29,7 +29,8 @@ Falcon Full Text Search Engine
 
 Requirements
 ------------
-* Python 3 or above
+* Python 3.7 or above
+* SQLite 3.9 or above with the JSON1 extension
 
 Features
 --------